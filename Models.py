@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, DateTime
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -8,6 +8,9 @@ Base = declarative_base()
 
 class Track(Base):
    __tablename__ = "race_tracks"
+   __table_args__ = (
+      Index('ix_race_tracks_track_name', 'track_name'),
+   )
 
    id = Column(Integer, primary_key=True)
    track_code = Column(String(40))
@@ -20,6 +23,9 @@ class Track(Base):
 
 class Races(Base):
    __tablename__ = "races"
+   __table_args__ = (
+      Index('uq_races_track_date_num', 'fk_track_id', 'race_date', 'race_num', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    fk_track_id = Column(Integer)
@@ -40,6 +46,9 @@ class Races(Base):
 
 class RaceBetTypes(Base):
    __tablename__ = "mapped_race_bet_types"
+   __table_args__ = (
+      Index('uq_race_bet_types_race_bet', 'fk_race_id', 'bet_type', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    fk_race_id = Column(Integer)
@@ -51,6 +60,9 @@ class RaceBetTypes(Base):
 
 class Horses(Base):
    __tablename__ = "horses"
+   __table_args__ = (
+      Index('uq_horses_name', 'name', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    name = Column(String(255))
@@ -62,6 +74,9 @@ class Horses(Base):
 
 class Jockeys(Base):
    __tablename__ = "jockeys"
+   __table_args__ = (
+      Index('uq_jockeys_name', 'name', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    name = Column(String(255))
@@ -72,6 +87,9 @@ class Jockeys(Base):
 
 class Trainers(Base):
    __tablename__ = "trainers"
+   __table_args__ = (
+      Index('uq_trainers_name', 'name', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    name = Column(String(255))
@@ -83,12 +101,15 @@ class Trainers(Base):
 
 class RaceResults(Base):
    __tablename__ = "race_results"
+   __table_args__ = (
+      Index('uq_race_results_race_horse', 'race_id', 'horse_id', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    race_id = Column(Integer)
-   horse_id = Column(String(40))
-   jockey_id = Column(DateTime)
-   trainer_id = Column(String(40))
+   horse_id = Column(Integer)
+   jockey_id = Column(Integer)
+   trainer_id = Column(Integer)
 
    pgm = Column(String(40))
    wps_win = Column(String(255))
@@ -119,6 +140,9 @@ class OpenRace(Base):
 
 class MappedHorseOdds(Base):
    __tablename__ = "mapped_res_horse_odds"
+   __table_args__ = (
+      Index('uq_horse_odds_race_horse', 'fk_race_id', 'fk_horse_id', unique=True),
+   )
 
    id = Column(Integer, primary_key=True)
    fk_horse_id = Column(Integer)
@@ -0,0 +1,162 @@
+"""
+Resumable historical backfill of a date range
+
+    python backfill.py 2022-07-01 2022-07-31 [--workers 2] [--from-archive DIR]
+
+Days are scraped and synced HRN_BACKFILL_WORKERS (or --workers) at a time,
+each track page in its own transaction through the batched sync. Every synced
+(date, track page) and every completed date is checkpointed in
+HRN_BACKFILL_STATE, a restart skips them without fetching them again. Track
+pages that failed, came back empty or with an error status, or whose track is
+missing from the database, stay pending and are retried by the next run. A
+date is only checkpointed once its date page (or archive partition) listed
+track pages and every one of them synced.
+
+Scraped pages are also written to the Parquet archive when HRN_ARCHIVE_DIR is
+set. --from-archive syncs archived days again without any HTTP request.
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import hrn_driver
+from horseracing_scrape import FETCH_WORKERS, group_races, iter_track_pages
+from horseracingnation import HorseRacingNation
+from metrics import get_metrics
+from race_archive import ARCHIVE_DIR, archive_page, archived_tracks, iter_archived_pages
+from race_state import BackfillCheckpoint, get_fingerprint_store
+from utils import log_blue, log_error, log_info, log_success, log_warn, set_log_level
+
+BACKFILL_WORKERS = int(os.getenv("HRN_BACKFILL_WORKERS", 2))
+
+
+def date_range(start, end):
+    """
+    Lists the dates from start to end, both included
+    :param start: First date, YYYY-MM-DD
+    :type start: str
+    :param end: Last date, YYYY-MM-DD
+    :type end: str
+    :return: The dates as YYYY-MM-DD
+    :rtype: list
+    """
+    first = datetime.strptime(start, "%Y-%m-%d")
+    last = datetime.strptime(end, "%Y-%m-%d")
+    if last < first:
+        raise ValueError(f'End date {end} is before start date {start}')
+    return [(first + timedelta(days=n)).strftime("%Y-%m-%d") for n in range((last - first).days + 1)]
+
+
+def backfill_day(race_date, checkpoint, from_archive=None):
+    """
+    Scrapes and syncs the track pages of one date that are not checkpointed yet
+    :param race_date: YYYY-MM-DD
+    :type race_date: str
+    :param checkpoint: Progress of the backfill, updated after every synced page
+    :type checkpoint: BackfillCheckpoint
+    :param from_archive: Read the date from this Parquet archive instead of the site
+    :type from_archive: str
+    :return: Number of track pages still pending for this date, 1 when the date listed none
+    :rtype: int
+    """
+    if checkpoint.day_done(race_date):
+        log_info('Backfill %s already done, skipping', race_date)
+        return 0
+
+    # every track page of the date, as listed by the date page or the archive partition
+    listed = {}
+    if from_archive:
+        listed[race_date] = archived_tracks(race_date, from_archive)
+        pages = iter_archived_pages(race_date, from_archive, skip=checkpoint.track_done)
+    else:
+        # workers > 1 gives this day thread-local sessions instead of the module-wide one
+        pages = iter_track_pages([race_date], workers=max(FETCH_WORKERS, 2), skip=checkpoint.track_done,
+                                 listed=listed.__setitem__)
+
+    for _, t_link, races in pages:
+        if not races:
+            log_warn(f'Backfill {race_date}: no races on {t_link}, left pending')
+            continue
+        if ARCHIVE_DIR and not from_archive:
+            archive_page(race_date, races, ARCHIVE_DIR)
+        hrn = HorseRacingNation(race_date, group_races(races))
+        track_info = {x['name']: {'race_count': x['raceCount']} for x in hrn.get_tracks()}
+        hrn_driver.sync_tracks(track_info)
+
+        synced = True
+        for track, info in track_info.items():
+            if not info.get('id'):
+                log_error(f'track missing from Databse: {track}')
+                synced = False
+                continue
+            if 'Camarero' in track:
+                continue
+            if hrn_driver.sync_track_races_batched(hrn, track, info['id'], info['race_count']) is None:
+                synced = False
+
+        if synced:
+            checkpoint.mark_track(race_date, t_link)
+
+    links = listed.get(race_date)
+    pending = sum(1 for t_link in links or () if not checkpoint.track_done(race_date, t_link))
+    if not links:
+        pending = 1
+        log_warn(f'Backfill {race_date}: no track pages listed, left pending')
+    elif pending:
+        log_warn(f'Backfill {race_date}: {pending} track pages left pending')
+    else:
+        checkpoint.mark_day(race_date)
+        log_blue(f'Backfill {race_date} done')
+    get_fingerprint_store().save()
+    return pending
+
+
+def backfill(start, end, workers=BACKFILL_WORKERS, checkpoint=None, from_archive=None):
+    """
+    Backfills every date from start to end, at most workers dates at a time
+    :return: Dates that still have pending track pages
+    :rtype: list
+    """
+    checkpoint = checkpoint or BackfillCheckpoint()
+    days = date_range(start, end)
+    incomplete = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(backfill_day, day, checkpoint, from_archive): day for day in days}
+        for future in as_completed(futures):
+            day = futures[future]
+            try:
+                if future.result():
+                    incomplete.append(day)
+            except Exception as e:
+                log_error(f'Backfill {day} failed: {e}')
+                incomplete.append(day)
+
+    fingerprints = get_fingerprint_store()
+    fingerprints.save()
+    fingerprints.summary()
+    get_metrics().export()
+    if incomplete:
+        log_warn(f'Backfill incomplete for {sorted(incomplete)}, run it again to resume')
+    else:
+        log_success(f'Backfill {start} .. {end} complete, {len(days)} days')
+    return sorted(incomplete)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scrape and sync a range of past race dates')
+    parser.add_argument('start', help='first date, YYYY-MM-DD')
+    parser.add_argument('end', help='last date, YYYY-MM-DD (included)')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='dates processed concurrently')
+    parser.add_argument('--from-archive', help='Parquet archive to read the dates from instead of the site')
+    args = parser.parse_args()
+
+    set_log_level('INFO')
+    hrn_driver.require_database()
+    backfill(args.start, args.end, args.workers, from_archive=args.from_archive)
+
+
+if __name__ == '__main__':
+    main()
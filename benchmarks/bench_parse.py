@@ -0,0 +1,229 @@
+"""
+Benchmarks of the parse and normalize hot paths on saved track pages
+
+    python benchmarks/bench_parse.py                      the committed fixtures
+    python benchmarks/bench_parse.py --snapshots DIR      pages recorded with HRN_SNAPSHOT_MODE=record
+    python benchmarks/bench_parse.py --json after.json --compare before.json
+
+Each case runs --repeat times over every card; timings are taken without
+tracemalloc, then one extra pass under tracemalloc reports the peak memory.
+Throughput is given in pages/s and races/s, --json saves the report and
+--compare prints the change against a previously saved one.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from db_utils import normalize_info
+from horseracing_scrape import group_races, parse_track_page, trasnform_dataframe
+from horseracingnation import HorseRacingNation
+from make_fixtures import FIXTURES_DIR
+from snapshots import SnapshotStore
+
+RACE_DATE = '2022-07-18'
+
+
+def load_fixtures(folder=FIXTURES_DIR):
+    pages = {}
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.html.gz'):
+            with gzip.open(os.path.join(folder, name), 'rb') as f:
+                pages[name[:-len('.html.gz')]] = f.read()
+    return pages
+
+
+def load_snapshots(root):
+    """Track pages of a snapshot store, the index and day pages hold no race blocks and are skipped"""
+    pages = {}
+    for snapshot in SnapshotStore(root).iter_snapshots():
+        if b'class="my-5"' in snapshot['body']:
+            pages[snapshot['url'].split('/entries-results/')[-1]] = snapshot['body']
+    return pages
+
+
+def build_cards(pages):
+    """Parses every page once and prepares the inputs of the downstream cases, so they time only their target"""
+    cards = {}
+    for name, content in pages.items():
+        races = parse_track_page(content)
+        grouped = group_races(races)
+        hrn = HorseRacingNation(RACE_DATE, grouped)
+        normalized = [race for track in grouped for _, race in hrn.iter_races(track)]
+        finished = [
+            (race['runners'], race['also_ran'],
+             hrn.build_race(race['ap']['Race Track'], race['ap']['Race Number']).runners_by_name)
+            for race in races if race['runners'] is not None
+        ]
+        cards[name] = {
+            'content': content, 'races': races, 'grouped': grouped, 'hrn': hrn, 'normalized': normalized,
+            'legacy_frames': [_legacy_entry_frame(race) for race in races],
+            'finished': finished,
+            'ha_races': [_ha_race(race) for race in normalized],
+        }
+    return cards
+
+
+def _legacy_entry_frame(race):
+    """The entries table as pd.read_html used to return it, stacked cells joined by two spaces"""
+    return pd.DataFrame([
+        {'PP': x['PP'], 'Horse / Sire': f"{x['Horse']}  {x['Sire']}",
+         'Trainer / Jockey': f"{x['Trainer']}  {x['Jockey']}", 'ML': x['ML']}
+        for x in race['race_results']
+    ])
+
+
+def _ha_race(race):
+    """The HorseAmerica style record normalize_info consumes, derived from a normalized race"""
+    start_utc = race['estimatedStartTime'] + timedelta(hours=4)
+    return {
+        'estimatedStartTime': start_utc.isoformat() + '.000Z',
+        'purse': int(race['purse'].replace('$', '').replace(',', '') or 0),
+        'status': 'OPEN',
+        'results': race['results'],
+    }
+
+
+def case_parse(card):
+    parse_track_page(card['content'])
+    return 1, len(card['races'])
+
+
+def case_transform(card):
+    for frame in card['legacy_frames']:
+        trasnform_dataframe(frame)
+    return 0, len(card['races'])
+
+
+def case_get_race(card):
+    # a fresh wrapper each pass, get_race memoizes and would otherwise measure cache hits
+    hrn = HorseRacingNation(RACE_DATE, card['grouped'])
+    for track, by_number in card['grouped'].items():
+        for number in by_number:
+            hrn.get_race(track, number)
+    return 0, len(card['races'])
+
+
+def case_get_race_cached(card):
+    hrn = card['hrn']
+    for track, by_number in card['grouped'].items():
+        for number in by_number:
+            hrn.get_race(track, number)
+    return 0, len(card['races'])
+
+
+def case_parse_race_results(card):
+    hrn = card['hrn']
+    for runners, also_ran, runners_by_name in card['finished']:
+        hrn._parse_race_results(runners, also_ran, runners_by_name)
+    return 0, len(card['finished'])
+
+
+def case_bet_types(card):
+    hrn = card['hrn']
+    for race in card['races']:
+        hrn._build_bet_type_aval_list(race['bet_type'])
+    return 0, len(card['races'])
+
+
+def case_normalize_info(card):
+    for race in card['ha_races']:
+        normalize_info(race, RACE_DATE)
+    return 0, len(card['races'])
+
+
+CASES = [
+    ('parse_track_page', case_parse),
+    ('trasnform_dataframe', case_transform),
+    ('HorseRacingNation.get_race', case_get_race),
+    ('get_race (memoized)', case_get_race_cached),
+    ('_parse_race_results', case_parse_race_results),
+    ('_build_bet_type_aval_list', case_bet_types),
+    ('db_utils.normalize_info', case_normalize_info),
+]
+
+
+def run_case(func, cards, repeat):
+    pages = races = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for card in cards.values():
+            p, r = func(card)
+            pages += p
+            races += r
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    for card in cards.values():
+        func(card)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'seconds': round(seconds, 6),
+        'pages_per_s': round(pages / seconds, 1) if pages else None,
+        'races_per_s': round(races / seconds, 1),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"{'case':<30}{'seconds':>10}{'pages/s':>11}{'races/s':>12}{'peak KiB':>11}{'vs base':>10}")
+    for name, row in report['cases'].items():
+        delta = ''
+        if baseline and name in baseline['cases']:
+            before = baseline['cases'][name]['races_per_s']
+            delta = f"{(row['races_per_s'] / before - 1) * 100:+.1f}%"
+        pages = f"{row['pages_per_s']:.1f}" if row['pages_per_s'] else '-'
+        print(f"{name:<30}{row['seconds']:>10.4f}{pages:>11}{row['races_per_s']:>12.1f}{row['peak_kib']:>11.1f}{delta:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parse and normalize hot paths')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help='folder of <name>.html.gz track pages')
+    parser.add_argument('--snapshots', help='benchmark the track pages of a snapshot store instead')
+    parser.add_argument('--repeat', type=int, default=20, help='passes over every card per case')
+    parser.add_argument('--only', action='append', help='run only the named case(s)')
+    parser.add_argument('--json', help='save the report to this file')
+    parser.add_argument('--compare', help='previously saved report to compare against')
+    args = parser.parse_args()
+
+    pages = load_snapshots(args.snapshots) if args.snapshots else load_fixtures(args.fixtures)
+    if not pages:
+        parser.error('no track pages found')
+
+    cards = build_cards(pages)
+
+    report = {
+        'cards': {name: len(card['races']) for name, card in cards.items()},
+        'repeat': args.repeat,
+        'cases': {},
+    }
+    print(f"{len(cards)} cards, {sum(report['cards'].values())} races, {args.repeat} passes")
+    for name, func in CASES:
+        if args.only and name not in args.only:
+            continue
+        report['cases'][name] = run_case(func, cards, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
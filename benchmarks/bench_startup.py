@@ -0,0 +1,108 @@
+"""
+Startup time budget of the command line and the main modules
+
+    python benchmarks/bench_startup.py [--runs 7] [--json report.json]
+
+Every case is started --runs times in a fresh interpreter, the median wall
+time is compared with its budget (milliseconds, on top of a bare `python -c
+pass`). The heaviest imports of each case are listed from -X importtime, and
+none of them may load the packages listed in LAZY_MODULES, e.g. pandas or
+SQLAlchemy for cli.py --help. The script exits 1 when a budget is exceeded or
+a lazy package is loaded, so it can gate a CI job.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (interpreter arguments, budget in ms above the bare interpreter)
+CASES = {
+    'cli.py --help': (['cli.py', '--help'], 60),
+    'cli.py sync --help': (['cli.py', 'sync', '--help'], 60),
+    'import horseracing_scrape': (['-c', 'import horseracing_scrape'], 400),
+    'import hrn_driver': (['-c', 'import hrn_driver'], 900),
+}
+
+# case -> packages it must not load, they are imported by the code that uses them
+LAZY_MODULES = {
+    'cli.py --help': ['requests', 'pandas', 'lxml', 'sqlalchemy', 'pyarrow'],
+    'cli.py sync --help': ['requests', 'pandas', 'lxml', 'sqlalchemy', 'pyarrow'],
+    'import horseracing_scrape': ['pandas', 'sqlalchemy', 'pyarrow'],
+    'import hrn_driver': ['pandas', 'pyarrow'],
+}
+
+
+def run_once(args, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + args
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.returncode:
+        raise RuntimeError(f'{" ".join(args)} exited with {result.returncode}: {result.stderr[-500:]}')
+    return elapsed, result.stderr
+
+
+def parse_importtime(stderr):
+    """{top level package: microseconds spent importing its modules} from -X importtime output"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        if not own.strip().isdigit():
+            continue
+        package = name.strip().split('.')[0]
+        imports[package] = imports.get(package, 0) + int(own)
+    return imports
+
+
+def median_ms(args, runs):
+    return statistics.median(run_once(args)[0] for _ in range(runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the startup time budget')
+    parser.add_argument('--runs', type=int, default=7, help='interpreter starts per case')
+    parser.add_argument('--top', type=int, default=5, help='heaviest imports listed per case')
+    parser.add_argument('--json', help='save the report to this file')
+    args = parser.parse_args()
+
+    baseline = median_ms(['-c', 'pass'], args.runs)
+    print(f'bare interpreter: {baseline:.1f} ms')
+    print(f"{'case':<28}{'median ms':>11}{'budget':>9}  heaviest imports")
+
+    report = {'baseline_ms': round(baseline, 1), 'cases': {}}
+    failures = []
+    for name, (case_args, budget) in CASES.items():
+        elapsed = median_ms(case_args, args.runs) - baseline
+        imports = parse_importtime(run_once(case_args, importtime=True)[1])
+        heaviest = sorted(imports.items(), key=lambda item: -item[1])[:args.top]
+        loaded = [m for m in LAZY_MODULES.get(name, []) if m in imports]
+
+        if elapsed > budget:
+            failures.append(f'{name}: {elapsed:.1f} ms over its {budget} ms budget')
+        if loaded:
+            failures.append(f'{name}: loads {", ".join(loaded)}')
+
+        report['cases'][name] = {'ms': round(elapsed, 1), 'budget_ms': budget,
+                                 'heaviest_ms': {m: round(us / 1000, 1) for m, us in heaviest}}
+        top = ', '.join(f'{m} {us / 1000:.0f}' for m, us in heaviest)
+        print(f'{name:<28}{elapsed:>11.1f}{budget:>9}  {top}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
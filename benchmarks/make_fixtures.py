@@ -0,0 +1,117 @@
+"""
+Writes the HorseRacingNation track page fixtures used by bench_parse.py
+
+The pages follow the markup of entries.horseracingnation.com track pages
+(race header, entries table, wagers, payouts, also-rans, pools and fractions),
+with a fixed seed so every run produces byte identical files. Cards of different
+sizes mix finished races, races still open and scratched runners:
+
+    python benchmarks/make_fixtures.py [output dir]
+
+Real pages recorded with HRN_SNAPSHOT_MODE=record can be benchmarked as well,
+see bench_parse.py --snapshots.
+"""
+
+import gzip
+import os
+import random
+import sys
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# name -> (track, races, runners per race, races with results, scratches per race)
+CARDS = {
+    'small': ('Evangeline Downs', 6, 6, 6, 0),
+    'medium': ('Saratoga', 10, 9, 7, 1),
+    'large': ('Gulfstream Park', 14, 14, 10, 2),
+    'prerace': ('Del Mar', 12, 10, 0, 1),
+}
+
+_WAGERS = ['$1 Exacta', '$0.50 Trifecta', '$0.10 Superfecta', '$1 Quinella', '$0.20 Super High Five']
+_SURFACES = ['Dirt', 'Turf', 'Synthetic']
+_DISTANCES = ['5 1/2 f', '6 f', '7 f', '1 mi', '1 1/16 mi', '1 1/8 mi']
+
+
+def race_html(rnd, track, number, runners, finished, scratches):
+    names = [f'{track.split()[0]} Runner {number}-{i}' for i in range(1, runners + 1)]
+    scratched = set(rnd.sample(range(1, runners + 1), scratches))
+
+    rows = []
+    for pp, name in enumerate(names, 1):
+        css = ' class="scratched"' if pp in scratched else ''
+        rows.append(
+            f'<tr{css}><td data-label="Program Number"><img src="/images/pp/{pp}.png" alt=""></td>\n'
+            f'<td data-label="Post Position">{pp}</td>\n'
+            f'<td data-label="Horse / Sire"><h4><a href="/horse/{name.replace(" ", "_")}">{name}</a></h4>\n'
+            f'  <p>Sire Of {name.split()[-1]}</p></td>\n'
+            f'<td data-label="Trainer / Jockey"><p>Trainer {rnd.randint(1, 12)}</p>\n'
+            f'  <p>Jockey {rnd.randint(1, 15)}</p></td>\n'
+            f'<td data-label="Morning Line Odds"><p>{rnd.randint(1, 30)}/1</p></td></tr>'
+        )
+
+    hour, minute = 12 + number // 2, rnd.randint(0, 59)
+    wagers = rnd.sample(_WAGERS, rnd.randint(2, len(_WAGERS)))
+    wagers.append(f'$1 Daily Double (Races {number}-{number + 1})')
+    if number % 3 == 1:
+        wagers.append(f'$0.50 Pick 3 (Races {number}-{number + 2})')
+
+    out = [
+        '<div class="my-5"><div class="row"><div class="col">',
+        f'<h2><a class="race-{number}" href="#race-{number}">\n  {track} Race # {number}, '
+        f'<time datetime="x">{hour - 12 if hour > 12 else hour}:{minute:02d} PM</time></a></h2></div>',
+        f'<div class="col"><div class="race-distance">{rnd.choice(_DISTANCES)}, {rnd.choice(_SURFACES)}, '
+        f'Allowance Optional Claiming, Race {number}</div>',
+        f'<div class="race-restrictions">{rnd.choice(["Fillies", "Colts", "Open"])} | {rnd.randint(2, 4)} yo</div>',
+        f'<div class="race-purse">Purse: ${rnd.randint(10, 150)},000</div></div></div>',
+        '<table class="table table-entries"><thead><tr><th>#</th><th>PP</th><th>Horse / Sire</th>'
+        '<th>Trainer / Jockey</th><th>ML</th></tr></thead>',
+        f'<tbody>{"".join(rows)}</tbody></table>',
+        f'<p class="race-wager-text">{" / ".join(wagers)}</p>',
+    ]
+
+    if finished:
+        live = [name for pp, name in enumerate(names, 1) if pp not in scratched]
+        rnd.shuffle(live)
+        out.append('<table class="table table-payouts"><thead><tr><th>Runner</th><th>Win</th><th>Place</th>'
+                   '<th>Show</th></tr></thead><tbody>')
+        for place, name in enumerate(live[:3]):
+            cells = [f'{rnd.uniform(2.1, 40):.2f}' if col >= place else '' for col in range(3)]
+            out.append(f'<tr><td>\n  {name}\n</td><td>{cells[0]}</td><td>{cells[1]}</td><td>{cells[2]}</td></tr>')
+        out.append('</tbody></table>')
+        out.append(f'<div class="also-rans">Also rans: {", ".join(live[3:])}</div>')
+        out.append('<table class="table table-pools"><thead><tr><th>Pool</th><th>Finish</th><th>$2 Payout</th>'
+                   '<th>Total Pool</th></tr></thead><tbody>')
+        for pool in wagers[:-1]:
+            finish = '-'.join(str(rnd.randint(1, runners)) for _ in range(3))
+            out.append(f'<tr><td>{pool}</td><td>{finish}</td><td>{rnd.uniform(10, 3000):.2f}</td>'
+                       f'<td>{rnd.randint(10000, 999999):,}</td></tr>')
+        out.append('</tbody></table>')
+        out.append(f'<div class="race-fractions">Fractions and final time: :22.{rnd.randint(10, 99)}, '
+                   f':45.{rnd.randint(10, 99)}, 1:1{rnd.randint(0, 9)}.{rnd.randint(10, 99)}</div>')
+
+    out.append('</div>')
+    return '\n'.join(out)
+
+
+def track_page(name):
+    track, races, runners, finished, scratches = CARDS[name]
+    rnd = random.Random(name)
+    body = '\n'.join(
+        race_html(rnd, track, n, runners, n <= finished, scratches)
+        for n in range(1, races + 1)
+    )
+    return f'<html><head><title>{track} Entries &amp; Results</title></head><body>\n<h1>{track}</h1>\n{body}\n</body></html>\n'
+
+
+def main(out_dir=FIXTURES_DIR):
+    os.makedirs(out_dir, exist_ok=True)
+    for name in CARDS:
+        path = os.path.join(out_dir, f'{name}.html.gz')
+        # mtime=0 keeps the gzip header, and so the committed files, reproducible
+        with gzip.GzipFile(path, 'wb', mtime=0) as f:
+            f.write(track_page(name).encode('utf-8'))
+        print(f'wrote {path}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
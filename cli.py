@@ -0,0 +1,122 @@
+"""
+Command line entry point of the scraper
+
+    python cli.py scrape   [--date YYYY-MM-DD ...] [--archive DIR] [--json FILE]
+    python cli.py sync     [--date YYYY-MM-DD] [--prod]
+    python cli.py backfill START END [--workers N] [--from-archive DIR]
+    python cli.py daemon   [--date YYYY-MM-DD]
+
+Only argparse is imported up front, each subcommand imports what it needs when
+it runs. --help, cron wrappers and worker processes therefore start without
+loading requests, pandas, lxml or SQLAlchemy, and the database engine is only
+built once a command talks to the database. benchmarks/bench_startup.py checks
+the startup time against a budget.
+"""
+
+import argparse
+import os
+import sys
+
+LOG_LEVEL = os.getenv("HRN_LOG_LEVEL", "INFO")
+
+
+def _configure_logging(args):
+    from utils import set_log_format, set_log_level
+
+    set_log_level(args.log_level)
+    if args.log_format:
+        set_log_format(args.log_format)
+
+
+def cmd_scrape(args):
+    """Scrapes and parses the given days without touching the database"""
+    import json
+
+    from horseracing_scrape import iter_track_pages
+    from metrics import get_metrics
+    from utils import log_info, log_success
+
+    archive_page = None
+    if args.archive:
+        from race_archive import archive_page
+
+    days = {}
+    for datekey, t_link, races in iter_track_pages(args.date or ['all']):
+        log_info(f'{t_link}: {len(races)} races')
+        days.setdefault(datekey, []).extend(races)
+        if archive_page:
+            archive_page(datekey, races, args.archive)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(days, f)
+    get_metrics().export()
+    log_success(f'Scraped {sum(len(races) for races in days.values())} races over {len(days)} days')
+    return 0
+
+
+def cmd_sync(args):
+    import hrn_driver
+
+    if args.prod:
+        hrn_driver.DEBUG = False
+    hrn_driver.main(args.date)
+    return 0
+
+
+def cmd_backfill(args):
+    import backfill
+    import hrn_driver
+
+    hrn_driver.require_database()
+    workers = args.workers or backfill.BACKFILL_WORKERS
+    incomplete = backfill.backfill(args.start, args.end, workers, from_archive=args.from_archive)
+    return 1 if incomplete else 0
+
+
+def cmd_daemon(args):
+    import race_daemon
+
+    race_daemon.main(args.date)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='HorseRacingNation scraper and database sync')
+    parser.add_argument('--log-level', default=LOG_LEVEL, type=str.upper,
+                        choices=['DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR', 'CRITICAL'])
+    parser.add_argument('--log-format', choices=['text', 'json'], help='defaults to HRN_LOG_FORMAT')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    scrape = commands.add_parser('scrape', help='scrape and parse pages, no database')
+    scrape.add_argument('--date', action='append', help='YYYY-MM-DD, repeatable (default: every listed day)')
+    scrape.add_argument('--archive', help='write the pages to this Parquet archive')
+    scrape.add_argument('--json', help='save the parsed races to this file')
+    scrape.set_defaults(func=cmd_scrape)
+
+    sync = commands.add_parser('sync', help='scrape a day and sync it to the database')
+    sync.add_argument('--date', help='YYYY-MM-DD (default: today)')
+    sync.add_argument('--prod', action='store_true', help='sync every track page, not only the first two')
+    sync.set_defaults(func=cmd_sync)
+
+    backfill = commands.add_parser('backfill', help='resumable scrape and sync of a date range')
+    backfill.add_argument('start', help='first date, YYYY-MM-DD')
+    backfill.add_argument('end', help='last date, YYYY-MM-DD (included)')
+    backfill.add_argument('--workers', type=int, help='dates processed concurrently (default: HRN_BACKFILL_WORKERS)')
+    backfill.add_argument('--from-archive', help='Parquet archive to read the dates from instead of the site')
+    backfill.set_defaults(func=cmd_backfill)
+
+    daemon = commands.add_parser('daemon', help='poll the tracks of a race day until every race is final')
+    daemon.add_argument('--date', help='YYYY-MM-DD (default: today)')
+    daemon.set_defaults(func=cmd_daemon)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    _configure_logging(args)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
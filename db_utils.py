@@ -1,3 +1,7 @@
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
 from datetime import datetime
 from Models import *
 from sqlalchemy import create_engine, engine, select
@@ -7,12 +11,53 @@ import pytz
 est = pytz.timezone('US/Eastern')
 utc = pytz.utc
 
-
-def get_engine(db_name, db_type, db_address, username, password, port=3306):
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 3600))
+IN_CHUNK_SIZE = int(os.getenv("DB_IN_CHUNK_SIZE", 500))
+IDENTITY_CACHE_SIZE = int(os.getenv("DB_IDENTITY_CACHE_SIZE", 50000))
+UPSERT_BATCH_SIZE = int(os.getenv("DB_UPSERT_BATCH_SIZE", 500))
+
+# natural key, columns refreshed when the key already exists
+UPSERT_KEYS = {
+    Horses: (('name',), ('sire',)),
+    Jockeys: (('name',), ()),
+    Trainers: (('name',), ()),
+    Races: (('fk_track_id', 'race_date', 'race_num'), ('race_status', 'race_class', 'fractional_times')),
+    RaceResults: (('race_id', 'horse_id'), (
+        'jockey_id', 'trainer_id', 'pgm', 'wps_win', 'wps_place', 'wps_show', 'fin_place', 'scratched', 'Morning_Line')),
+    RaceBetTypes: (('fk_race_id', 'bet_type'), ()),
+    MappedHorseOdds: (('fk_race_id', 'fk_horse_id'), ()),
+}
+
+_identity_cache = None
+
+
+def get_engine(db_name, db_type, db_address, username, password, port=3306, pool_size=DB_POOL_SIZE,
+               max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE):
+    """
+    Builds the SQLAlchemy engine with a tuned connection pool
+    :param pool_size: Connections kept open, at least one per sync worker
+    :type pool_size: int
+    :param max_overflow: Extra connections allowed under load
+    :type max_overflow: int
+    :param pool_pre_ping: Test connections before use, drops ones the server closed
+    :type pool_pre_ping: bool
+    :param pool_recycle: Seconds after which a connection is replaced (< MySQL wait_timeout)
+    :type pool_recycle: int
+    :return: The engine
+    """
     engine = None
     db_url = f"{db_type}+py{db_type}://{username}:{password}@{db_address}:{port}/{db_name}"
-    print(f'Initializing Database Engine, name: {db_name}, type: {db_type}, address: {db_address}')
-    engine = create_engine(db_url)
+    print(f'Initializing Database Engine, name: {db_name}, type: {db_type}, address: {db_address}, pool: {pool_size}+{max_overflow}')
+    engine = create_engine(
+        db_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=pool_pre_ping,
+        pool_recycle=pool_recycle
+    )
     return engine
 
 
@@ -54,6 +99,9 @@ def get_db_tracks(track_names, session):
 
 def get_db_races(track_id, race_date, session):
     resultsDict = {}
+    if isinstance(race_date, str):
+        # a bound datetime compares the same on every backend, a 'YYYY-MM-DD' string only on MySQL
+        race_date = datetime.strptime(race_date, '%Y-%m-%d')
     stmt = select(Races).where(Races.race_date == race_date).where(Races.fk_track_id == track_id)
     results = session.scalars(stmt).all()
     resultsDict = {r.race_num : r for r in results}
@@ -67,6 +115,30 @@ def get_db_race_results(race_id, session):
     resultsDict = {r.horse_id : r for r in results}
     return resultsDict
 
+def get_db_bet_types_for_races(race_ids, session):
+    resultsDict = {r: {} for r in race_ids}
+    stmt = select(RaceBetTypes).where(RaceBetTypes.fk_race_id.in_(race_ids))
+    for r in session.scalars(stmt).all():
+        resultsDict.setdefault(r.fk_race_id, {})[r.bet_type] = r
+    return resultsDict
+
+
+def get_db_race_results_for_races(race_ids, session):
+    resultsDict = {r: {} for r in race_ids}
+    stmt = select(RaceResults).where(RaceResults.race_id.in_(race_ids))
+    for r in session.scalars(stmt).all():
+        resultsDict.setdefault(r.race_id, {})[int(r.horse_id)] = r
+    return resultsDict
+
+
+def get_mapped_odds_for_races(race_ids, session):
+    resultsDict = {r: {} for r in race_ids}
+    stmt = select(MappedHorseOdds).where(MappedHorseOdds.fk_race_id.in_(race_ids))
+    for r in session.scalars(stmt).all():
+        resultsDict.setdefault(r.fk_race_id, {})[r.fk_horse_id] = r
+    return resultsDict
+
+
 def get_open_races(session):
     resultsDict = None
     stmt = select(OpenRace)
@@ -83,6 +155,233 @@ def get_mapped_odds(race_id, session):
     return resultsDict
 
 
+def chunked(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def identity_key(name):
+    """
+    Key a name is matched under, the way MySQL's default collations compare it:
+    case and accent insensitive, trailing spaces ignored
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().rstrip(' ')
+
+
+class IdentityCache():
+    """
+    Process level name -> row cache for Horses, Jockeys and Trainers.
+
+    Rows are (id,) tuples, (id, sire) for horses. Names are cached under their
+    identity_key, so a scraped name that differs from the stored one only in
+    case, accents or trailing spaces finds the row the database would match.
+    Names a lookup did not find are remembered as absent (until registered), so
+    a prefetch followed by a resolve does not query them twice. Each entity type
+    keeps at most max_size names, and as many absent ones, and evicts the least
+    recently used ones, so long backfills stay bounded. Lookups are thread safe.
+    """
+
+    _columns = {
+        Horses: (Horses.id, Horses.sire),
+        Jockeys: (Jockeys.id,),
+        Trainers: (Trainers.id,),
+    }
+
+    def __init__(self, max_size=IDENTITY_CACHE_SIZE):
+        self._max_size = max_size
+        self._rows = {model: OrderedDict() for model in self._columns}
+        self._absent = {model: OrderedDict() for model in self._columns}
+        self._lock = threading.Lock()
+
+    def register(self, model, name, row):
+        key = identity_key(name)
+        with self._lock:
+            rows = self._rows[model]
+            rows[key] = tuple(row)
+            rows.move_to_end(key)
+            while len(rows) > self._max_size:
+                rows.popitem(last=False)
+            self._absent[model].pop(key, None)
+
+    def _mark_absent(self, model, names):
+        with self._lock:
+            absent = self._absent[model]
+            for name in names:
+                key = identity_key(name)
+                if key not in self._rows[model]:
+                    absent[key] = True
+                    absent.move_to_end(key)
+            while len(absent) > self._max_size:
+                absent.popitem(last=False)
+
+    def is_absent(self, model, name):
+        with self._lock:
+            return identity_key(name) in self._absent[model]
+
+    def get(self, model, name):
+        key = identity_key(name)
+        with self._lock:
+            row = self._rows[model].get(key)
+            if row is not None:
+                self._rows[model].move_to_end(key)
+            return row
+
+    def _load(self, model, names, session):
+        """Reads names from the database, the rows are returned under the requested names"""
+        requested = {}
+        for name in names:
+            requested.setdefault(identity_key(name), []).append(name)
+        loaded = {}
+        for chunk in chunked(list(names)):
+            stmt = select(model.name, *self._columns[model]).where(model.name.in_(chunk))
+            for db_name, *row in session.execute(stmt):
+                self.register(model, db_name, row)
+                for name in requested.get(identity_key(db_name), ()):
+                    loaded[name] = tuple(row)
+        self._mark_absent(model, [name for name in names if name not in loaded])
+        return loaded
+
+    def prefetch(self, model, names, session):
+        """Loads every name neither cached nor known absent with one IN query per chunk"""
+        missing = [n for n in set(names) if self.get(model, n) is None and not self.is_absent(model, n)]
+        self._load(model, missing, session)
+
+    def resolve(self, model, names, session, refresh=False):
+        """
+        Returns {name: row} for every name found in the cache or the database
+        :param model: Horses, Jockeys or Trainers
+        :param names: Names to look up
+        :type names: iterable
+        :param refresh: Query the names known absent too, e.g. right after inserting them
+        :type refresh: bool
+        :return: Cached rows, names that do not exist yet are absent
+        :rtype: dict
+        """
+        resolved, missing = {}, []
+        for name in set(names):
+            row = self.get(model, name)
+            if row is not None:
+                resolved[name] = row
+            elif refresh or not self.is_absent(model, name):
+                missing.append(name)
+        resolved.update(self._load(model, missing, session))
+        return resolved
+
+    def clear(self):
+        with self._lock:
+            for rows in (*self._rows.values(), *self._absent.values()):
+                rows.clear()
+
+
+def get_identity_cache():
+    global _identity_cache
+    if _identity_cache is None:
+        _identity_cache = IdentityCache()
+    return _identity_cache
+
+
+def prefetch_identities(scrape_runners, session):
+    """
+    Warms the identity cache with every horse, trainer and jockey name of a scrape
+    (e.g. a whole day) so later per-track lookups are served from memory
+    :param scrape_runners: runner dicts as produced by HorseRacingNation.get_race
+    :type scrape_runners: iterable
+    """
+    runners = list(scrape_runners)
+    cache = get_identity_cache()
+    cache.prefetch(Horses, {x['name'] for x in runners}, session)
+    cache.prefetch(Trainers, {x['trainer'] for x in runners}, session)
+    cache.prefetch(Jockeys, {x['jockey'] for x in runners}, session)
+
+
+def as_row(record):
+    """Turns an unsaved model instance (build_* helpers) into an upsert row"""
+    return {c.key: getattr(record, c.key) for c in record.__table__.columns if not c.primary_key}
+
+
+def _upsert_statement(dialect, table, chunk, key, update):
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+
+        stmt = insert(table).values(chunk)
+        # a no-op assignment keeps existing rows untouched when there is nothing to refresh
+        columns = update or key[:1]
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in columns})
+
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+
+        stmt = insert(table).values(chunk)
+        if not update:
+            return stmt.on_conflict_do_nothing(index_elements=list(key))
+        return stmt.on_conflict_do_update(index_elements=list(key), set_={c: stmt.excluded[c] for c in update})
+
+    raise NotImplementedError(f'Upserts are not supported for the {dialect} dialect')
+
+
+def upsert_rows(model, rows, session, update_columns=None, batch_size=UPSERT_BATCH_SIZE):
+    """
+    Inserts rows, or refreshes update_columns where the natural key (UPSERT_KEYS)
+    already exists, with one multi-row statement per batch_size rows.
+    Requires the unique keys declared in Models.
+    :param model: One of the UPSERT_KEYS models
+    :param rows: Column name -> value dicts, all with the same keys
+    :type rows: list
+    :param session: Session whose connection runs the statements
+    :param update_columns: Overrides the default refreshed columns
+    :type update_columns: iterable
+    :param batch_size: Rows per statement
+    :type batch_size: int
+    :return: Number of statements executed
+    :rtype: int
+    """
+    if not rows:
+        return 0
+
+    key, update = UPSERT_KEYS[model]
+    update = update if update_columns is None else update_columns
+    # never refresh a column the rows do not carry, it would be overwritten with NULL
+    update = tuple(c for c in update if c in rows[0])
+    dialect = session.get_bind().dialect.name
+
+    statements = 0
+    for chunk in chunked(rows, batch_size):
+        session.execute(_upsert_statement(dialect, model.__table__, chunk, key, update))
+        statements += 1
+    log_debug(f'upserted {len(rows)} {model.__tablename__} rows in {statements} statements')
+    return statements
+
+
+def upsert_horses(rows, session, **kwargs):
+    return upsert_rows(Horses, rows, session, **kwargs)
+
+
+def upsert_jockeys(rows, session, **kwargs):
+    return upsert_rows(Jockeys, rows, session, **kwargs)
+
+
+def upsert_trainers(rows, session, **kwargs):
+    return upsert_rows(Trainers, rows, session, **kwargs)
+
+
+def upsert_races(rows, session, **kwargs):
+    return upsert_rows(Races, rows, session, **kwargs)
+
+
+def upsert_race_results(rows, session, **kwargs):
+    return upsert_rows(RaceResults, rows, session, **kwargs)
+
+
+def upsert_bet_types(rows, session, **kwargs):
+    return upsert_rows(RaceBetTypes, rows, session, **kwargs)
+
+
+def upsert_horse_odds(rows, session, **kwargs):
+    return upsert_rows(MappedHorseOdds, rows, session, **kwargs)
+
+
 def find_missing_tracks(missing_names, track_info, session):
     key_map = {k.lower(): k for k in track_info}
 
@@ -145,7 +444,7 @@ def normalize_info(hrn_race, today_label):
 
 
 def update_race_record(db_record, hrn_race):
-    log_info(f'Updating Race: {db_record.fk_track_id}/{str(db_record.race_date)[:10]}/{db_record.race_num}/')
+    log_info('Updating Race: %s/%.10s/%s/', db_record.fk_track_id, db_record.race_date, db_record.race_num)
 
     if not db_record.race_class:
         db_record.race_class = hrn_race['raceClass']
@@ -155,7 +454,7 @@ def update_race_record(db_record, hrn_race):
 
 
 def build_race_record(track_id, hrn_race, today_label):
-    log_info(f'Adding New Race: {track_id}/{today_label}/{hrn_race["raceNumber"]}/')
+    log_info('Adding New Race: %s/%s/%s/', track_id, today_label, hrn_race['raceNumber'])
     new_race = Races(
         fk_track_id = track_id,
         race_num = hrn_race['raceNumber'],
@@ -217,22 +516,37 @@ def add_new_bet_type_mapping(race_id, bet_type):
     return bet_type
 
 
+def find_race_result(runner, race_results):
+    """
+    Looks up the result of a runner by program number. race_results is either
+    the results_by_number index of a race (preferred) or its results list.
+    """
+    if not race_results:
+        return None
+
+    number = int(runner['number'])
+    if isinstance(race_results, dict):
+        return race_results.get(number)
+
+    for x in race_results:
+        if int(x['number']) == number:
+            return x
+    return None
+
+
 def build_race_res_record(race_id, horse_id, jockey_id, trainer_id, runner, race_results=[]):
-    log_info(f'Adding New Race Result: {race_id}/{horse_id}/')
+    log_info('Adding New Race Result: %s/%s/', race_id, horse_id)
     wps_win = ''
     wps_place = ''
     wps_show = ''
     fin_place = None
     scratched = 0
 
-    if race_results:
-        for x in race_results:
-            if int(x['number']) == int(runner['number']):
-                wps_win, wps_place, wps_show = x['Win'], x['Place'], x['Show']
-                fin_place = x['fin_place']
-                break
+    result = find_race_result(runner, race_results)
+    if result:
+        wps_win, wps_place, wps_show = result['Win'], result['Place'], result['Show']
+        fin_place = result['fin_place']
 
-    
     if runner['scratched']:
         scratched = 1
 
@@ -253,20 +567,18 @@ def build_race_res_record(race_id, horse_id, jockey_id, trainer_id, runner, race
 
 
 def update_race_res_record(db_record, jockey_id, trainer_id, runner, race_results=[]):
-    log_info(f'Updating Race Result: {db_record.id}/{db_record.horse_id}')
+    log_info('Updating Race Result: %s/%s', db_record.id, db_record.horse_id)
     wps_win = ''
     wps_place = ''
     wps_show = ''
     fin_place = None
     scratched = 0
 
-    if race_results:
-        for x in race_results:
-            if int(x['number']) == int(runner['number']):
-                wps_win, wps_place, wps_show = x['Win'], x['Place'], x['Show']
-                fin_place = x['fin_place']
-                break
-    
+    result = find_race_result(runner, race_results)
+    if result:
+        wps_win, wps_place, wps_show = result['Win'], result['Place'], result['Show']
+        fin_place = result['fin_place']
+
     if runner['scratched']:
         scratched = 1
 
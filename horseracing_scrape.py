@@ -9,14 +9,35 @@ Tables:
     Pool
 """
 
+import multiprocessing
+import os
+import re
+import threading
 import warnings
-import pandas as pd
-from utils import log_debug, fetch_session, log_error, log_info, log_warn, set_log_level
-from lxml.etree import tostring
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+import time
+from metrics import get_metrics, incr, timer
+from race_export import FlatRaceExporter
+from utils import log_debug, fetch_session, fetch_thread_session, log_error, log_info, log_warn, set_log_level
+from lxml.etree import XPath
 from lxml.html import fromstring
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-_session = fetch_session()
+BASE_URL = "https://entries.horseracingnation.com"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.4 Safari/605.1.15"
+}
+
+# FETCH_WORKERS of 1 keeps the original sequential behaviour through the global session
+FETCH_WORKERS = int(os.getenv("HRN_FETCH_WORKERS", 1))
+PER_HOST_LIMIT = int(os.getenv("HRN_PER_HOST_LIMIT", 4))
+# PARSE_WORKERS of 0 parses in-process, above that pages are parsed in a process pool
+PARSE_WORKERS = int(os.getenv("HRN_PARSE_WORKERS", 0))
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
 
 
 def splice_column(record, element=0):
@@ -35,34 +56,303 @@ def trasnform_dataframe(record):
 
 
 
-def horse_racing_scrape(days=['all'], debug=False):
-    global _session
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.4 Safari/605.1.15"
+def _host_slot(url, limit):
+    """
+    Returns the semaphore bounding concurrent requests to the host of url
+    :param url: The url about to be fetched
+    :type url: str
+    :param limit: Max in-flight requests for that host
+    :type limit: int
+    :return: A shared semaphore for (host, limit)
+    :rtype: threading.BoundedSemaphore
+    """
+    key = (urlsplit(url).netloc, limit)
+    with _host_slots_lock:
+        if key not in _host_slots:
+            _host_slots[key] = threading.BoundedSemaphore(limit)
+        return _host_slots[key]
+
+
+def _count_page(res):
+    incr('pages')
+    incr('bytes', len(res.content))
+    if getattr(res, 'from_cache', False):
+        incr('http_cache_hits')
+    return res
+
+
+def _fetch(path):
+    with timer('http_fetch'):
+        return _count_page(fetch_session().get(BASE_URL + path, headers=HEADERS))
+
+
+def _fetch_concurrent(path, per_host=PER_HOST_LIMIT):
+    url = BASE_URL + path
+    with _host_slot(url, per_host):
+        with timer('http_fetch'):
+            return _count_page(fetch_thread_session().get(url, headers=HEADERS))
+
+
+def _fetch_pages(paths, workers=FETCH_WORKERS, per_host=PER_HOST_LIMIT):
+    """
+    Fetches every path, yielding responses in the same order as paths
+    (never in completion order), so callers parse identically in both modes.
+    At most workers * 2 pages are in flight or waiting to be consumed.
+    :param paths: Site relative links
+    :type paths: list
+    :param workers: Thread count, 1 fetches lazily one page at a time
+    :type workers: int
+    :param per_host: Max concurrent requests per host
+    :type per_host: int
+    :return: Responses
+    :rtype: generator
+    """
+    if workers <= 1:
+        yield from map(_fetch, paths)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(_fetch_concurrent, path, per_host))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Race relative expressions, compiled once and evaluated against each div.my-5 race block
+_X_TITLE = XPath("*//a[contains(@class,'race-')]/text()")
+_X_TIME = XPath("*//a[contains(@class,'race-')]//time/text()")
+_X_DISTANCE = XPath(".//div[contains(@class,'race-distance')]/text()")
+_X_RESTRICTIONS = XPath(".//div[contains(@class,'race-restrictions')]/text()")
+_X_PURSE = XPath(".//div[contains(@class,'race-purse')]/text()")
+_X_WAGERS = XPath(".//p[@class='race-wager-text']/text()")
+_X_ALSO_RANS = XPath(".//div[contains(@class,'also-rans')]/text()")
+_X_FRACTIONS = XPath(".//div[contains(@class,'race-fractions')]/text()")
+_X_TABLES = XPath(".//table")
+_X_HEADER = XPath("(thead/tr | tr)[th][1]/th")
+_X_ROWS = XPath("tbody/tr[td] | tr[td]")
+
+_RE_WHITESPACE = re.compile(r"[\r\n]+|\s{2,}")
+
+ENTRY_COLUMNS = ['PP', 'Horse', 'Sire', 'Trainer', 'Jockey', 'ML', '#']
+RUNNER_COLUMNS = ['Runner', 'Horse Number', 'Win', 'Place', 'Show']
+
+
+def _cell_text(cell):
+    # same whitespace folding pd.read_html applies to cell text
+    return _RE_WHITESPACE.sub(" ", cell.text_content().strip())
+
+
+def _cell_parts(cell, element):
+    """Returns the element-th text fragment of a stacked cell (Horse / Sire, Trainer / Jockey)"""
+    parts = [t.strip() for t in cell.itertext() if t.strip()]
+    if len(parts) > element:
+        return parts[element]
+    return _cell_text(cell)
+
+
+def _table_records(table):
+    """
+    Reads a table element into a list of records keyed by the header text.
+    Stacked cells additionally expose their fragments as '<header>#0', '<header>#1',
+    and every record carries a 'scratched' flag taken from the row class.
+    """
+    header = [_cell_text(th) for th in _X_HEADER(table)]
+    records = []
+    for row in _X_ROWS(table):
+        record = {'scratched': 'scratched' in (row.get('class') or '').split()}
+        for name, cell in zip(header, row.xpath("td")):
+            record[name] = _cell_text(cell)
+            if ' / ' in name:
+                record[name + '#0'] = _cell_parts(cell, 0)
+                record[name + '#1'] = _cell_parts(cell, 1)
+        records.append(record)
+    return records
+
+
+def extract_race(race):
+    """
+    Extracts one race block straight from the parsed lxml tree
+    :param race: The div.my-5 element of a race
+    :type race: lxml.html.HtmlElement
+    :return: ap dict plus bet_type, race_results, runners, also_ran and pool record lists
+             (runners, also_ran and pool are None when the race has no results yet)
+    :rtype: dict
+    """
+    tables = _X_TABLES(race)
+
+    results = []
+    for rec in _table_records(tables[0]):
+        results.append({
+            'PP': rec.get('PP', ''),
+            'Horse': rec.get('Horse / Sire#0', ''),
+            'Sire': rec.get('Horse / Sire#1', ''),
+            'Trainer': rec.get('Trainer / Jockey#0', ''),
+            'Jockey': rec.get('Trainer / Jockey#1', ''),
+            'ML': rec.get('ML', ''),
+            '#': rec['scratched'],
+        })
+
+    runner_table = None
+    if len(tables) > 1:
+        pp_by_horse = {}
+        for entry in results:
+            pp_by_horse.setdefault(entry['Horse'], entry['PP'])
+
+        runner_table = []
+        for rec in _table_records(tables[1]):
+            runner = {k: rec.get(k, '') for k in RUNNER_COLUMNS}
+            runner['Horse Number'] = pp_by_horse.get(runner['Runner'].strip(), runner['Horse Number'])
+            runner_table.append(runner)
+
+    ap_dic = {}
+    race_title = _X_TITLE(race)[0].replace("\n","").strip()
+    ap_dic['Race Track'] = race_title.split("Race")[0].strip()
+    ap_dic['Race Number'] = race_title.split("Race")[1].replace(",","").replace("#","").strip()
+    ap_dic['Race Time'] = _X_TIME(race)[0].replace("\n","").strip()
+    race_dis = _X_DISTANCE(race)[0].strip()
+    ap_dic['Length'] = race_dis.split(",")[0].strip()
+    ap_dic['Surface'] = race_dis.split(",")[1].strip()
+    ap_dic['Race Class'] = race_dis.split(",", 2)[2].strip()
+    restrictions = _X_RESTRICTIONS(race)[0].strip()
+    ap_dic['Sex'] = restrictions.split("|")[0].strip()
+    ap_dic['Age'] = restrictions.split("|")[1].strip()
+    ap_dic['Purse'] = _X_PURSE(race)[0].replace("Purse:","").strip()
+
+    bet_types = []
+    for idx, bet_type in enumerate(_X_WAGERS(race)[0].split("/")):
+        if idx == 0:
+            ap_dic['Bet Types'] = bet_type.strip()
+            ap_dic['#'] = idx + 1
+        bet_types.append({'Bet Types': bet_type.strip(), '#': idx + 1})
+
+    also_rans = None
+    also_rans_text = _X_ALSO_RANS(race)
+    if also_rans_text:
+        also_rans_text = also_rans_text[0].replace("Also rans:","").strip()
+        also_rans = [{'Also Rans': ran.strip()} for ran in also_rans_text.split(",")]
+
+    pool = None
+    fractions = _X_FRACTIONS(race)
+    if len(tables) > 2 and fractions:
+        pool = [
+            {k: v for k, v in rec.items() if k != 'scratched' and '#' not in k}
+            for rec in _table_records(tables[2])
+        ]
+        for rec in pool:
+            rec['Finish'] = "( " + rec.get('Finish', '') + ")"
+        if pool:
+            pool[0]['Fraction time'] = fractions[0].replace("Fractions and final time:","").strip()
+        else:
+            pool = None
+
+    return {
+        "ap" : ap_dic,
+        "bet_type" : bet_types,
+        "race_results" : results,
+        "runners" : runner_table,
+        "also_ran" : also_rans,
+        "pool" : pool
+    }
+
+
+def race_frames(race_record):
+    """
+    Builds the DataFrame form of an extracted race, the shape table_dfs has always exposed
+    :param race_record: Output of extract_race
+    :type race_record: dict
+    :return: ap dict and one DataFrame (or None) per table
+    :rtype: dict
+    """
+    # pandas is only needed here, importing it lazily keeps the scraper quick to start
+    import pandas as pd
+
+    def frame(records, columns=None):
+        if records is None:
+            return None
+        return pd.DataFrame.from_records(records, columns=columns)
+
+    return {
+        "ap" : race_record['ap'],
+        "bet_type" : frame(race_record['bet_type'], ['Bet Types', '#']),
+        "race_results" : frame(race_record['race_results'], ENTRY_COLUMNS),
+        "runners" : frame(race_record['runners'], RUNNER_COLUMNS),
+        "also_ran" : frame(race_record['also_ran'], ['Also Rans']),
+        "pool" : frame(race_record['pool'])
     }
 
-    main_df = None
-    table_dfs = {}
+
+def parse_track_page(content):
+    """
+    Parses one track page into its race records
+    :param content: Raw page bytes
+    :type content: bytes
+    :return: One extract_race dict per race on the page
+    :rtype: list
+    """
+    html = fromstring(content)
+    return [extract_race(race) for race in html.xpath("//div[@class='my-5']")]
+
+
+def _parse_timed(content):
+    """parse_track_page plus its duration, measured where the parse runs (possibly a worker process)"""
+    start = time.perf_counter()
+    races = parse_track_page(content)
+    return races, time.perf_counter() - start
+
+
+def _count_races(races):
+    incr('races', len(races))
+    incr('runners', sum(len(race['race_results']) for race in races))
+    return races
+
+
+def fetch_track_page(t_link):
+    """
+    Fetches and parses a single track page, used to refresh one track of a card
+    :param t_link: Site relative track link, as yielded by iter_track_pages
+    :type t_link: str
+    :return: One extract_race dict per race on the page
+    :rtype: list
+    """
+    log_debug('Scraping Page: %s%s', BASE_URL, t_link)
+    res = _fetch(t_link)
+    # an error page parses to no races, which would look like a track that dropped off the card
+    res.raise_for_status()
+    races, seconds = _parse_timed(res.content)
+    get_metrics().observe('html_parse', seconds)
+    return _count_races(races)
+
+
+def _nav_links(days):
+    if days[0] != 'all':
+        log_debug(f'Filtering results: {days}')
+        return [f'/entries-results/{x}' for x in days]
+
     log_debug(f'fetching Main Page: {days} : {len(days)}')
-    main_res = _session.get("https://entries.horseracingnation.com/entries-results", headers = headers)
+    main_res = fetch_session().get(BASE_URL + "/entries-results", headers=HEADERS)
+    main_res.raise_for_status()
     main_html = fromstring(main_res.content)
 
     log_debug('Extracting Nav Links')
     nav_links = main_html.xpath("//li[@class='nav-item']//a[contains(@class,'nav-link')]/@href")
-
     log_info(f'Found Nav Links: {len(nav_links)}')
-    
-    if days[0] != 'all':
-        nav_links = [f'/entries-results/{x}' for x in days]
-        log_debug(f'Filtering results: {days}')
+    return nav_links
+
+
+def _iter_track_contents(days, workers, per_host, skip=None, listed=None):
+    nav_links = _nav_links(days)
 
-    for link in nav_links:
+    for link, nav_res in zip(nav_links, _fetch_pages(nav_links, workers, per_host)):
         print(link)
         datekey = link[link.rfind('/') + 1:]
-        table_dfs[datekey] = {}
+        if not nav_res.ok:
+            log_error(f'{link} answered {nav_res.status_code}, skipping the day')
+            continue
 
         track_links = None
-        nav_res = _session.get("https://entries.horseracingnation.com"+link, headers=headers)
         nav_html = fromstring(nav_res.content)
 
         try:
@@ -75,123 +365,139 @@ def horse_racing_scrape(days=['all'], debug=False):
             log_warn(f'Failed to load link: {link}')
             continue
 
-        main_df = pd.DataFrame()
         log_debug(f'Found {len(track_links)} Track links (Races) for {link} (Date)')
-        
-        for t_link in track_links:
-            log_debug(f'Scraping Page: https://entries.horseracingnation.com{t_link}')
-            res = _session.get("https://entries.horseracingnation.com"+t_link, headers=headers)
-            html = fromstring(res.content)
-            data = res.text
-
-            try:
-                log_debug('Parsing Scratched names from Table')
-                scratched = html.xpath("//tr[@class='scratched']/td[contains(@data-label,'Program')]")
-                for scratch in scratched:
-                    to_rem = tostring(scratch).decode("utf-8")
-                    data = data.replace(to_rem, '<td>TRUE</td>')
-            except Exception as e:
-                log_warn(f'Failed to read scratched names on page: {t_link}')
-
-            html = fromstring(data)
-            all_races = html.xpath("//div[@class='my-5']")
-
-            print(f"    {t_link} Races ({len(all_races)})")
-
-            for race in all_races:
-                tables = pd.read_html(tostring(race))
-                results = tables[0][['PP', 'Horse / Sire', 'Trainer / Jockey','ML', '#']].copy()
-
-                trasnform_dataframe(results)
-                results = results[['PP', 'Horse','Sire', 'Trainer','Jockey','ML',"#"]].fillna('')
-                try:
-                    runner_table = tables[1]
-                    for i in range(len(runner_table)):
-                        check = runner_table.loc[i,'Runner'].strip()
-                        for j in range(len(results)):
-                            if check == results.loc[j,'Horse']:
-                                runner_table.loc[i,'Horse Number'] = results.loc[j,'PP']
-                                break
-                    runner_table = runner_table[['Runner', 'Horse Number','Win', 'Place','Show']].fillna('')
-                except:
-                    runner_table = None
-                ap_dic = {}
-                race_title = race.xpath("*//a[contains(@class,'race-')]/text()")[0].replace("\n","").strip()
-                ap_dic['Race Track'] = race_title.split("Race")[0].strip()
-                ap_dic['Race Number'] = race_title.split("Race")[1].replace(",","").replace("#","").strip()
-                ap_dic['Race Time'] = race.xpath("*//a[contains(@class,'race-')]//time/text()")[0].replace("\n","").strip()
-                race_dis = race.xpath("//div[contains(@class,'race-distance')]/text()")[0].strip()
-                ap_dic['Length'] = race_dis.split(",")[0].strip()
-                ap_dic['Surface'] = race_dis.split(",")[1].strip()
-                ap_dic['Race Class'] = race_dis.split(",", 2)[2].strip()
-                restrictions = race.xpath("//div[contains(@class,'race-restrictions')]/text()")[0].strip()
-                ap_dic['Sex'] = restrictions.split("|")[0].strip()
-                ap_dic['Age'] = restrictions.split("|")[1].strip()
-                ap_dic['Purse'] = race.xpath("//div[contains(@class,'race-purse')]/text()")[0].replace("Purse:","").strip()
-                bet_type_df = pd.DataFrame(columns=['Bet Types','#'])
-                bet_types = race.xpath(".//p[@class='race-wager-text']/text()")[0]
-                for idx,type in enumerate(bet_types.split("/")):
-
-                    if idx == 0:
-                        ap_dic['Bet Types'] = type.strip()
-                        ap_dic['#'] = idx+1
-
-                    bet_type_df.at[idx,'Bet Types'] = type.strip()
-                    bet_type_df.at[idx,'#'] = idx+1
-                try:
-                    also_rans = race.xpath(".//div[contains(@class,'also-rans')]/text()")[0].replace("Also rans:","").strip()
-                    also_rans_df = pd.DataFrame(columns=['Also Rans'])
-                    for id,ran in enumerate(also_rans.split(",")):
-                        also_rans_df.loc[id,'Also Rans'] = ran.strip()
-                except:
-                    also_rans_df = None
-                try:
-                    pool_df = tables[2]
-                    for i in range(len(pool_df)):
-                        pool_df.at[i,'Finish'] = "( "+str(pool_df.at[i,'Finish']).replace("nan","")+ ")"
-                    race_fraction = race.xpath(".//div[contains(@class,'race-fractions')]/text()")[0].replace("Fractions and final time:","").strip()
-                    pool_df.at[0,'Fraction time'] = race_fraction
-                except:
-                    pool_df = None
-
-                if ap_dic['Race Track'] not in table_dfs[datekey]:
-                    table_dfs[datekey][ap_dic['Race Track']] = {}
-                
-                table_dfs[datekey][ap_dic['Race Track']][ap_dic['Race Number']] = {
-                    "ap" : ap_dic, 
-                    "bet_type" : bet_type_df, 
-                    "race_results" : results, 
-                    "runners" : runner_table, 
-                    "also_ran" : also_rans_df,
-                    "pool" : pool_df
-                }
-
-                if debug and len(table_dfs[datekey]) == 2:
-                    return table_dfs
-                
-                df = pd.DataFrame()
-                df = df.append(ap_dic, ignore_index=True)
-                df = df.append(bet_type_df, ignore_index=True)
-                df = pd.concat([df,results],axis=1, ignore_index=True)
-                df = pd.concat([df,runner_table],axis=1, ignore_index=True)
-                df = pd.concat([df,also_rans_df],axis=1, ignore_index=True)
-                df = pd.concat([df,pool_df],axis=1, ignore_index=True)
-                main_df = main_df.append(df, ignore_index=True)
-
-        log_debug('Trimming Data Columns')
-        try:
-            main_df.columns = ['Race Track','Race Number','Race Time','Length','Surface','Race Class','Sex','Age','Purse','Bet Types','#','PP','Horse','Sire','Trainer','Jockey','Morning Line ML','Scratched','Runner Name','Horse Number','Win','Place','Show','Runner Name','Pool','Finish',	'$2 Payout','Total Pool','Fractions and Final time']
-        except:
-            log_warn('Failed inital Column Parse, attempting 2nd Parse')
-            try:
-                main_df.columns = ['Race Track','Race Number','Race Time','Length','Surface','Race Class','Sex','Age','Purse','Bet Types','#','PP','Horse','Sire','Trainer','Jockey','Morning Line ML','Scratched']
-            except:
-                log_error('Failed 2nd attempt Column Parse, Data is lost')
+        if listed:
+            listed(datekey, list(track_links))
+        if skip:
+            track_links = [t_link for t_link in track_links if not skip(datekey, t_link)]
+
+        for t_link, res in zip(track_links, _fetch_pages(track_links, workers, per_host)):
+            if not res.ok:
+                log_error(f'{t_link} answered {res.status_code}, skipping the page')
                 continue
+            log_debug('Scraping Page: %s%s', BASE_URL, t_link)
+            yield datekey, t_link, res.content
+
+
+def _parse_pages(pages, parse_workers=PARSE_WORKERS):
+    """
+    Parse stage, either inline or in a process pool fed with the raw page bytes.
+    Results come back in page order, with at most parse_workers * 2 pages queued.
+    """
+    metrics = get_metrics()
+    if parse_workers <= 0:
+        for datekey, t_link, content in pages:
+            races, seconds = _parse_timed(content)
+            metrics.observe('html_parse', seconds)
+            yield datekey, t_link, races
+        return
+
+    # the fetch threads are already running, a forked worker could inherit a lock one of them holds
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+        pending = deque()
+        for datekey, t_link, content in pages:
+            pending.append((datekey, t_link, pool.submit(_parse_timed, content)))
+            if len(pending) >= parse_workers * 2:
+                datekey, t_link, future = pending.popleft()
+                races, seconds = future.result()
+                metrics.observe('html_parse', seconds)
+                yield datekey, t_link, races
+        while pending:
+            datekey, t_link, future = pending.popleft()
+            races, seconds = future.result()
+            metrics.observe('html_parse', seconds)
+            yield datekey, t_link, races
+
+
+def iter_track_pages(days=['all'], workers=FETCH_WORKERS, per_host=PER_HOST_LIMIT, parse_workers=PARSE_WORKERS,
+                     skip=None, listed=None):
+    """
+    Yields (date, track_link, races) as soon as each track page is parsed,
+    in site order. Only the pages inside the fetch and parse windows are held in memory.
+    :param days: Dates as YYYY-MM-DD, or ['all'] for every day in the site navigation
+    :type days: list
+    :param workers: Fetch threads, 1 fetches sequentially
+    :type workers: int
+    :param per_host: Max concurrent requests per host
+    :type per_host: int
+    :param parse_workers: Parser processes, 0 parses in the calling process
+    :type parse_workers: int
+    :param skip: Optional skip(date, track_link) -> bool, matching track pages are not fetched
+    :type skip: callable
+    :param listed: Optional listed(date, track_links), called with every track link a date page lists,
+        before skip. Track pages answering an error status are logged and not yielded
+    :type listed: callable
+    :return: The date key, the track page link and the page's race records
+    :rtype: generator
+    """
+    pages = _iter_track_contents(days, workers, per_host, skip, listed)
+    for datekey, t_link, races in _parse_pages(pages, parse_workers):
+        print(f"    {t_link} Races ({len(races)})")
+        _count_races(races)
+        yield datekey, t_link, races
+
+
+def iter_races(days=['all'], workers=FETCH_WORKERS, per_host=PER_HOST_LIMIT, parse_workers=PARSE_WORKERS):
+    """
+    Streaming scrape API, yields (date, track, race_number, race) for every race
+    as soon as its track page is parsed. race is the extract_race record dict.
+    """
+    for datekey, t_link, races in iter_track_pages(days, workers, per_host, parse_workers):
+        for race in races:
+            yield datekey, race['ap']['Race Track'], race['ap']['Race Number'], race
+
+
+def group_races(races):
+    """Arranges race records as {track: {race_number: race}}, the HorseRacingNation input shape"""
+    grouped = {}
+    for race in races:
+        grouped.setdefault(race['ap']['Race Track'], {})[race['ap']['Race Number']] = race
+    return grouped
+
+
+def horse_racing_scrape(days=['all'], debug=False, workers=FETCH_WORKERS, per_host=PER_HOST_LIMIT,
+                        export=None, export_dir='.', parse_workers=PARSE_WORKERS):
+    """
+    Scrapes every track page of the requested days, see iter_races for the streaming form
+    :param days: Dates as YYYY-MM-DD, or ['all'] for every day in the site navigation
+    :type days: list
+    :param debug: Stop after the first races of the second track
+    :type debug: bool
+    :param workers: Fetch threads, 1 fetches sequentially
+    :type workers: int
+    :param per_host: Max concurrent requests per host
+    :type per_host: int
+    :param parse_workers: Parser processes, 0 parses in the calling process
+    :type parse_workers: int
+    :param export: None, 'csv' or 'xlsx', streams flat race rows to one file per date
+    :type export: str
+    :param export_dir: Folder for exported files
+    :type export_dir: str
+    :return: table_dfs[date][track][race_number] -> ap dict and DataFrames
+    :rtype: dict
+    """
+    table_dfs = {} if days[0] == 'all' else {x: {} for x in days}
+    exporter = None
 
-        main_df.fillna("",inplace=True)
-        # main_df.to_csv(link.split("/")[-1]+"-V3.csv",index=False
-
+    try:
+        for datekey, track, race_number, race_record in iter_races(days, workers, per_host, parse_workers):
+            day = table_dfs.setdefault(datekey, {})
+            with timer('race_frames'):
+                day.setdefault(track, {})[race_number] = race_frames(race_record)
+
+            if export:
+                if exporter is None or exporter.race_date != datekey:
+                    if exporter:
+                        exporter.close()
+                    exporter = FlatRaceExporter(datekey, export, export_dir)
+                exporter.write_race(race_record)
+
+            if debug and len(day) == 2:
+                return table_dfs
+    finally:
+        if exporter:
+            exporter.close()
 
     return table_dfs
 
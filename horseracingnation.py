@@ -1,67 +1,117 @@
 
-from glob import escape
-from operator import mul
+from functools import lru_cache
+from hrn_models import Race, Result, Runner
+from metrics import timed
 from utils import *
 import re
 
+KNOWN_BET_TYPES = frozenset([
+    'EXACTA','TRIFECTA','SUPERFECTA','QUINELLA','DAILY DOUBLE','CONSOLATION DOUBLE','TRIACTOR','Z-5 SUPER HI-5',
+    'SUPER HIGH FIVE JACKPOT','GRAND SLAM','SUPER HIGH FIVE','X-5 SUPER HIGH FIVE','EXACTOR','PERFECTA'])
+
+
+@lru_cache(maxsize=1024)
+def _normalize_wager(wager):
+    """Bet types named by one wager text, cached as the same few texts repeat across every card"""
+    w = wager.upper()
+    if w in KNOWN_BET_TYPES:
+        return (w,)
+    elif 'DOUBLE' in w:
+        return ('DAILY DOUBLE',)
+    elif '(' in w:
+        multi_race_bets = re.split(r'\(([^\)]+)\)', w)
+        return tuple(seg.strip() for seg in multi_race_bets if 'RACES' not in seg and seg != '')
+    return (w.strip(),)
+
+
 class HorseRacingNation():
     """Wrapper for Horse Racing Nation Data Object
     creates clean interface for retreiving race related data
+
+    Races are normalized lazily, once per (track, race number), and memoized.
+    The returned dicts are shared between callers and must not be modified.
+    Feed newer scrape data of a track with update() (or invalidate() it) to
+    drop its memoized races.
     """
     def __init__(self, race_date, scrape_data):
         self._race_date = race_date
+        self._race_datetime = datetime.strptime(race_date, "%Y-%m-%d")
         self._scrape_data = scrape_data
-        self._known_bet_types = [
-            'EXACTA','TRIFECTA','SUPERFECTA','QUINELLA','DAILY DOUBLE','CONSOLATION DOUBLE','TRIACTOR','Z-5 SUPER HI-5',
-            'SUPER HIGH FIVE JACKPOT','GRAND SLAM','SUPER HIGH FIVE','X-5 SUPER HIGH FIVE','EXACTOR','PERFECTA']
+        self._known_bet_types = KNOWN_BET_TYPES
+        self._races = {}
+        self._tracks = None
         return None
 
+    @property
+    def race_date(self):
+        return self._race_date
+
     def get_tracks(self):
-        tracks = []
-
-        for track in self._scrape_data:
-            tracks.append({
-                'name' : track,
-                'raceCount' : len(self._scrape_data[track])
-            })
-        
-        return tracks
+        if self._tracks is None:
+            self._tracks = [
+                {'name' : track, 'raceCount' : len(races)}
+                for track, races in self._scrape_data.items()
+            ]
+        return self._tracks
+
+    def invalidate(self, track_name=None):
+        """
+        Drops the memoized races of one track, or of every track
+        :param track_name: Track name as scraped, None for all tracks
+        :type track_name: str
+        :return: None
+        """
+        self._tracks = None
+        if track_name is None:
+            self._races.clear()
+            return
+        for key in [k for k in self._races if k[0] == track_name]:
+            del self._races[key]
+
+    def update(self, scrape_data):
+        """
+        Feeds newer scrape data, {track: {race_number: race}}, replacing those tracks
+        :param scrape_data: Tracks scraped again, as produced by group_races
+        :type scrape_data: dict
+        :return: None
+        """
+        for track_name, races in scrape_data.items():
+            self._scrape_data[track_name] = races
+            self.invalidate(track_name)
     
-    def _parse_race_results(self, race_res, also_rans, runners):
+    @staticmethod
+    def _records(table):
+        """Scraped tables arrive as DataFrames (horse_racing_scrape) or lists of records"""
+        if table is None:
+            return None
+        if hasattr(table, 'to_dict'):
+            return table.to_dict('records')
+        return table
+
+    def _parse_race_results(self, race_res, also_rans, runners_by_name):
         # if 'runners' in race_data and (not race_data['runners'].empty):
         #     race_res = race_data['runners']
 
-        also_rans = also_rans.to_dict()
-        for k in sorted(also_rans['Also Rans'].keys()):
-            try:
-                name = also_rans['Also Rans'][k]
-                if name == '':
-                    break
-
-                runner = runners.query(f'Horse == "{name}"')
-                race_res = race_res.append({
-                        'Runner' : name,
-                        'Horse Number' : runner.iloc[0]['PP'],
-                        'Win' : '-', 
-                        'Place' : '-', 
-                        'Show' : '-'
-                    }, 
-                    ignore_index=True
-                )
-            except Exception as e:
-                log_warn(f'error reading also_ran horse: {e}')
+        race_res = [
+            {'name': r['Runner'], 'number': r['Horse Number'], 'Win': r['Win'], 'Place': r['Place'], 'Show': r['Show']}
+            for r in race_res
+        ]
+        for ran in (also_rans or []):
+            name = ran['Also Rans']
+            if name == '':
+                break
+
+            runner = runners_by_name.get(name)
+            if runner is None:
+                log_warn(f'error reading also_ran horse: {name} not in entries')
                 continue
+            race_res.append({'name': name, 'number': runner.number, 'Win': '-', 'Place': '-', 'Show': '-'})
 
-        race_res = race_res.rename(
-            {'Runner':'name', 'Horse Number': 'number'},
-            axis='columns'
-        )
-        race_res = self._convert_numbers(race_res.to_dict('records'))
-
-        for i in range(len(race_res)):
-            race_res[i]['fin_place'] = (i + 1)
-        
-        return race_res
+        race_res = self._convert_numbers(race_res)
+        return [
+            Result(x['name'], x['number'], x['Win'], x['Place'], x['Show'], i + 1)
+            for i, x in enumerate(race_res)
+        ]
     
     def _convert_numbers(self, record_list):
         resp = []
@@ -74,85 +124,107 @@ class HorseRacingNation():
         return resp
 
     def _build_bet_type_aval_list(self, wager_types_extracted):
-        wagers_split = wager_types_extracted['Bet Types'].to_list()
         wagers = []
-
-        for w in wagers_split:
-            if w.upper() in self._known_bet_types:
-                wagers.append(w.upper())
-            elif 'DOUBLE' in w.upper():
-                wagers.append('DAILY DOUBLE')
-            elif '(' in w.upper():
-                multi_race_bets = re.split(r'\(([^\)]+)\)', w.upper())
-                for seg in multi_race_bets:
-                    if 'RACES' not in seg and seg != '':
-                        wagers.append(seg.strip())
-            else:
-                wagers.append(w.upper().strip())
-
+        for x in wager_types_extracted:
+            wagers.extend(_normalize_wager(x['Bet Types']))
         return wagers
 
-
-    def get_race(self, track_name, race_number):
-        race = {}
+    def build_race(self, track_name, race_number):
+        """
+        Normalizes one scraped race into a typed Race
+        :param track_name: Track name as scraped
+        :type track_name: str
+        :param race_number: Race number as scraped
+        :type race_number: str
+        :return: The race with its runner and result indexes
+        :rtype: Race
+        """
         race_data = self._scrape_data[track_name][race_number]
         est_time = race_data['ap']['Race Time']
-        race_datetime = datetime.strptime(self._race_date, "%Y-%m-%d")
-        race['raceNumber'] = int(race_number)
-        race['runners'] = []
-        race['race_date'] = race_datetime
-        race['off_at_time_est'] = est_time
-        race['estimatedStartTime'] = add_to_datetime(race_datetime, est_time)
-        race['status'] = 'OPEN'
-        race['distance'] = race_data['ap']['Length']
-        race['raceClass'] = race_data['ap']['Race Class']
-        race['surface'] = race_data['ap']['Surface']
-        race['purse'] = race_data['ap']['Purse']
-        race['betTypesAvailable'] = self._build_bet_type_aval_list(race_data['bet_type'])
-        race['betTypesCompleted'] = []
-        race['results'] = []
-        
-        try:
-            # what happens here can be unpredictable
-            race['betTypesCompleted'] = race_data['pool']['Pool'].tolist()
-        except:
-            race['betTypesCompleted'] = []
+        race_datetime = self._race_datetime
 
         # build runners... (Yes the table names are backwards)
-        runners = race_data['race_results'].rename(
-            {'Horse':'name', 'PP': 'number', 'Sire' : 'sire', 'Trainer' : 'trainer', 'Jockey' : 'jockey', '#' : 'scratched', 'ML': 'morningLine'},
-            axis='columns'
-        )
-        runners = self._convert_numbers(runners.to_dict('records'))
-        race['runners'] = runners
+        entries = self._convert_numbers([
+            {'number': x['PP'], 'name': x['Horse'], 'sire': x['Sire'], 'trainer': x['Trainer'],
+             'jockey': x['Jockey'], 'morningLine': x['ML'], 'scratched': x['#']}
+            for x in self._records(race_data['race_results'])
+        ])
+        runners = [
+            Runner(x['name'], x['number'], x['sire'], x['trainer'], x['jockey'], x['morningLine'], x['scratched'])
+            for x in entries
+        ]
+        runners_by_name = Race.index(runners, 'name')
 
         # Build Race Results
-        try:
-            race_results = self._parse_race_results(
-                race_res=race_data['runners'], 
-                also_rans=race_data['also_ran'], 
-                runners=race_data['race_results']
-            )
-            race['results'] = race_results
-        except Exception as e:
-            if 'NoneType' not in str(e):
+        results = []
+        runner_table = self._records(race_data['runners'])
+        if runner_table is not None:
+            try:
+                results = self._parse_race_results(
+                    race_res=runner_table,
+                    also_rans=self._records(race_data['also_ran']),
+                    runners_by_name=runners_by_name
+                )
+            except Exception as e:
                 log_warn(f'No Race Results from HRN: {e}')
-            pass
-
-
-        # update status if there are results
-        if race['results']:
-            race['status'] = 'FINAL'
 
+        pool = self._records(race_data['pool']) or []
         try:
-            frac_time = race_data['pool'].at[0, 'Fraction time'].split(',')[-1]
+            frac_time = pool[0]['Fraction time'].split(',')[-1]
             frac_time = str.strip(frac_time)
             if frac_time[0] == ':':
                 frac_time = '0' + frac_time
-            race['fractional_times'] = frac_time
         except:
-            race['fractional_times'] = ''
-            pass
-    
+            frac_time = ''
+
+        return Race(
+            raceNumber=int(race_number),
+            race_date=race_datetime,
+            off_at_time_est=est_time,
+            estimatedStartTime=add_to_datetime(race_datetime, est_time),
+            # update status if there are results
+            status='FINAL' if results else 'OPEN',
+            distance=race_data['ap']['Length'],
+            raceClass=race_data['ap']['Race Class'],
+            surface=race_data['ap']['Surface'],
+            purse=race_data['ap']['Purse'],
+            betTypesAvailable=self._build_bet_type_aval_list(self._records(race_data['bet_type'])),
+            betTypesCompleted=[x['Pool'] for x in pool],
+            fractional_times=frac_time,
+            runners=runners,
+            results=results,
+            runners_by_name=runners_by_name,
+            runners_by_number=Race.index(runners, 'number'),
+            results_by_number=Race.index(results, 'number'),
+        )
+
+    def get_race(self, track_name, race_number):
+        """
+        Returns the normalized race dict, built on first access
+        :param track_name: Track name as scraped
+        :type track_name: str
+        :param race_number: Race number as scraped
+        :type race_number: str
+        :return: Race.to_dict() of the race, shared, do not modify
+        :rtype: dict
+        """
+        key = (track_name, race_number)
+        race = self._races.get(key)
+        if race is None:
+            race = self._races[key] = self._normalize(track_name, race_number)
         return race
 
+    @timed('normalize')
+    def _normalize(self, track_name, race_number):
+        return self.build_race(track_name, race_number).to_dict()
+
+    def iter_races(self, track_name):
+        """
+        Normalizes a whole track card, yields (race_number, race) in race order
+        :param track_name: Track name as scraped
+        :type track_name: str
+        :return: Race numbers as scraped and the get_race dicts
+        :rtype: generator
+        """
+        for race_number in sorted(self._scrape_data[track_name], key=int):
+            yield race_number, self.get_race(track_name, race_number)
@@ -1,9 +1,16 @@
 import os
 import sys
-from horseracing_scrape import horse_racing_scrape
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from horseracing_scrape import group_races, horse_racing_scrape, iter_track_pages
 from utils import log_blue, log_info, log_warn, set_log_level, log_debug, log_error, log_success
 
 from horseracingnation import HorseRacingNation
+from metrics import get_metrics, instrument_engine, timed
+from race_archive import ARCHIVE_DIR, archive_page
+from race_state import get_fingerprint_store
+from staging_queue import QUEUE_PATH, Flusher, StagingQueue
 from Models import *
 from datetime import date
 from db_utils import *
@@ -19,18 +26,57 @@ DB_TYPE = os.getenv("DB_TYPE", None)
 DB_UPDATES = os.getenv("DB_UPDATES", True)
 DB_INSERTS = os.getenv("DB_INSERTS", True)
 DEBUG = os.getenv("DEBUG", True)
-
-today = date.today()
-today_label = today.strftime("%Y-%m-%d")
+# 'row' commits race by race and runner by runner, 'batched' writes a whole track card in one transaction
+DB_SYNC_MODE = os.getenv("DB_SYNC_MODE", "row")
+# tracks synced concurrently, each worker has its own session; above 1 the batched sync is always used
+DB_SYNC_WORKERS = int(os.getenv("DB_SYNC_WORKERS", 1))
+# seconds the run waits at exit for the staging queue (HRN_STAGING_QUEUE) to drain, the rest waits for the next flush
+QUEUE_DRAIN_TIMEOUT = float(os.getenv("HRN_QUEUE_DRAIN_TIMEOUT", 300))
+
+# sessionmaker of the database, built on first use by get_sessions()
 Sessions = None
-set_log_level('DEBUG')
-
-try:
-    db_engine = get_engine(DB_NAME, DB_TYPE, DB_ADDRESS, DB_USERNAME, DB_PASSWORD, DB_PORT)
-    Sessions = sessionmaker(bind=db_engine)
-except:
-    print('DB Engine failed, Check your environment variables')
-    exit()
+_engine_lock = threading.Lock()
+_identity_lock = threading.Lock()
+
+
+def today_label():
+    return date.today().strftime("%Y-%m-%d")
+
+
+def get_sessions():
+    """
+    Returns the sessionmaker of the database, the engine is only built by the
+    first caller so importing this module costs no connection setup
+    :return: The session factory
+    :rtype: sessionmaker
+    """
+    global Sessions
+    if Sessions is None:
+        with _engine_lock:
+            if Sessions is None:
+                try:
+                    db_engine = get_engine(
+                        DB_NAME, DB_TYPE, DB_ADDRESS, DB_USERNAME, DB_PASSWORD, DB_PORT,
+                        pool_size=max(DB_POOL_SIZE, DB_SYNC_WORKERS)
+                    )
+                except Exception as e:
+                    log_error(f'DB Engine failed, Check your environment variables: {e}')
+                    raise
+                instrument_engine(db_engine)
+                Sessions = sessionmaker(bind=db_engine)
+    return Sessions
+
+
+def new_session():
+    return get_sessions()()
+
+
+def require_database():
+    """Builds the engine up front so a command with unusable DB settings exits before scraping"""
+    try:
+        get_sessions()
+    except Exception:
+        sys.exit(1)
 
 
 def compare_race_count(db_races, track_name, count):
@@ -56,7 +102,7 @@ def extract_dependencies(hrn_race):
 
 def sync_tracks(track_info={}):
     name_list = list(track_info.keys())
-    with Sessions() as session:
+    with new_session() as session:
         try:
             db_tracks = get_db_tracks(name_list, session=session)
 
@@ -76,12 +122,15 @@ def sync_tracks(track_info={}):
     return track_info
 
 
+@timed('db_sync_track')
 def sync_track_races_today(hrn, track_name, track_id, race_count):
     hrn_race_cache = {}
-    with Sessions() as session:
+    race_date = hrn.race_date
+    fingerprints = get_fingerprint_store()
+    with new_session() as session:
         try:
 
-            db_races = get_db_races(track_id, today_label, session=session)
+            db_races = get_db_races(track_id, race_date, session=session)
             db_state = compare_race_count(db_races, track_name, race_count)
             log_info(f'Today\'s races for {track_name}, are in a state of: {db_state}')
         
@@ -90,32 +139,36 @@ def sync_track_races_today(hrn, track_name, track_id, race_count):
                     print('track')
 
                 hrn_race = hrn.get_race(track_name, str(r))
-                    
+                race_key = fingerprints.key(race_date, track_name, r)
+                # the state file alone can be stale, e.g. after the database was restored
+                if str(r) in db_races and fingerprints.unchanged(race_key, hrn_race['fingerprint']):
+                    continue
+
                 
                 # Sync Race
                 if str(r) in db_races:
                     db_race = db_races[str(r)]
                     update_race_record(db_race, hrn_race)
                 else:
-                    db_race = build_race_record(track_id, hrn_race, today_label)
+                    db_race = build_race_record(track_id, hrn_race, race_date)
 
                 if session.dirty:
-                    log_debug(f'race: {db_race.id} Commiting Updates to race')
+                    log_debug('race: %s Commiting Updates to race', db_race.id)
                 
                 session.add(db_race)
                 session.commit()
 
                 # Collect Dependencies
-                log_debug(f'race: {db_race.id} building race dependencies')
-                ha_horses, ha_odds, ha_trainers, ha_jockeys = extract_dependencies(hrn_race)
+                log_debug('race: %s building race dependencies', db_race.id)
+                runners = hrn_race['runners']
                 race_bet_types = get_db_bet_types(db_race.id, session=session)
-                db_horses = get_db_horses(ha_horses, session=session)
-                db_trainers = get_db_trainers(ha_trainers, session=session)
-                db_jockeys = get_db_horses(ha_jockeys, session=session)
+                db_horses = _resolve_identities(Horses, {x['name']: x for x in runners}, build_horse_record)
+                db_trainers = _resolve_identities(Trainers, {x['trainer']: x for x in runners}, build_trainer_record)
+                db_jockeys = _resolve_identities(Jockeys, {x['jockey']: x for x in runners}, build_jockey_record)
                 mapped_odds = get_mapped_odds(db_race.id, session=session)
                 db_race_results = get_db_race_results(db_race.id, session=session)
 
-                log_debug(f'Checking Bet Types for {db_race.id}')
+                log_debug('Checking Bet Types for %s', db_race.id)
                 if len(hrn_race['betTypesAvailable']) > len(race_bet_types):
                     log_debug('Bet Types out of sync')
                     for x in hrn_race['betTypesAvailable']:
@@ -126,59 +179,43 @@ def sync_track_races_today(hrn, track_name, track_id, race_count):
                     log_debug('Bet Types up to date')
 
                 
-                for runner in hrn_race['runners']:
-
-                    if runner['name'] in db_horses:
-                        horse_record = db_horses[runner['name']]
-                        horse_record.sire = runner['sire']
-                    else:
-                        horse_record = build_horse_record(runner)
-
-                    if runner['trainer'] in db_trainers:
-                        trainer_record = db_trainers[runner['trainer']]
-                    else:
-                        trainer_record = build_trainer_record(runner)
-
-                    if runner['jockey'] in db_jockeys:
-                        jockey_record = db_jockeys[runner['jockey']]
-                    else:
-                        jockey_record = build_jockey_record(runner)
-                    
-                    session.add_all([horse_record, trainer_record, jockey_record])
-                    session.commit()
+                for runner in runners:
+                    horse_id = db_horses[runner['name']][0]
+                    trainer_id = db_trainers[runner['trainer']][0]
+                    jockey_id = db_jockeys[runner['jockey']][0]
 
                     res_record =  None
-                    if horse_record.id in db_race_results:
-                        res_record = db_race_results[horse_record.id]
+                    if horse_id in db_race_results:
+                        res_record = db_race_results[horse_id]
 
                     if hrn_race['results']:
                         if res_record:
                             update_race_res_record(
                                 db_record=res_record,
-                                jockey_id = jockey_record.id,
-                                trainer_id = trainer_record.id,
+                                jockey_id = jockey_id,
+                                trainer_id = trainer_id,
                                 runner = runner, 
-                                race_results =  hrn_race['results']
+                                race_results = hrn_race['results_by_number']
                             )
                     
                     if not res_record:
                         res_record = build_race_res_record(
                             race_id=db_race.id,
-                            horse_id = horse_record.id,
-                            jockey_id = jockey_record.id, 
-                            trainer_id = trainer_record.id, 
+                            horse_id = horse_id,
+                            jockey_id = jockey_id, 
+                            trainer_id = trainer_id, 
                             runner = runner, 
-                            race_results =  hrn_race['results']
+                            race_results = hrn_race['results_by_number']
                         )
                         session.add(res_record)
 
-                    if horse_record.id in mapped_odds:
+                    if horse_id in mapped_odds:
                         log_debug('odds already exist, skipping')
                         pass
                     else:
-                        log_debug(f'adding new odds for horse: {horse_record.id}')
+                        log_debug('adding new odds for horse: %s', horse_id)
                         odds_record = build_horse_odds(
-                            db_horse_id=horse_record.id,
+                            db_horse_id=horse_id,
                             db_race_id=db_race.id,
                             result_id=res_record.id,
                             ha_odds='',
@@ -187,52 +224,285 @@ def sync_track_races_today(hrn, track_name, track_id, race_count):
                         session.add(odds_record)
 
                     session.commit()
+
+                fingerprints.update(race_key, hrn_race['fingerprint'])
    
         except Exception as e:
             log_error(f'Critical Error: {e}')
 
     return hrn_race_cache
 
-def main():
-    log_warn(f"RUNNING IN DEBUG: {DEBUG}")
-    scrape_data = horse_racing_scrape([today_label], debug=DEBUG)
-    log_info(f'Scrapping complete: {list(scrape_data.keys())}')
+def _upsert_and_reload(session, upsert, records, reload):
+    """
+    Writes new rows with multi-row upserts and returns them re-read by natural
+    key, which is how the batched sync picks up generated primary keys without
+    a round trip per row. A row another writer inserted meanwhile is refreshed
+    instead of failing the track on its unique key.
+    """
+    upsert([as_row(record) for record in records], session)
+    return reload()
+
+
+def _resolve_identities(model, by_name, build_record):
+    """
+    Maps names to identity cache rows. Names the database does not know yet are
+    upserted and committed in a short transaction of their own, serialized by
+    _identity_lock, so tracks synced in parallel never insert the same horse,
+    trainer or jockey twice. Horse sires that changed are written back with one
+    executemany UPDATE.
+    """
+    cache = get_identity_cache()
+    with _identity_lock, new_session() as session:
+        rows = cache.resolve(model, by_name, session)
+        new = [name for name in by_name if name not in rows]
+        if new:
+            upsert_rows(model, [as_row(build_record(by_name[name])) for name in new], session)
+            rows.update(cache.resolve(model, new, session, refresh=True))
+
+        if model is Horses:
+            changed = [name for name in by_name if name not in new and rows[name][1] != by_name[name]['sire']]
+            if changed:
+                session.bulk_update_mappings(Horses, [{'id': rows[n][0], 'sire': by_name[n]['sire']} for n in changed])
+                for name in changed:
+                    cache.register(Horses, name, (rows[name][0], by_name[name]['sire']))
+
+        session.commit()
+    return rows
+
+
+def prefetch_cards(cards):
+    """
+    Warms the identity cache with every horse, trainer and jockey of the given
+    tracks in one IN query per entity, so the batched syncs that follow resolve
+    their names from memory instead of querying track by track
+    :param cards: (HorseRacingNation, track name) pairs
+    :type cards: iterable
+    """
+    try:
+        runners = [runner for hrn, track in cards for _, race in hrn.iter_races(track) for runner in race['runners']]
+        if not runners:
+            return
+        with _identity_lock, new_session() as session:
+            prefetch_identities(runners, session)
+    except Exception as e:
+        log_warn(f'Identity prefetch failed, names are resolved per track: {e}')
+
+
+@timed('db_sync_track')
+def sync_track_races_batched(hrn, track_name, track_id, race_count):
+    """
+    Batched variant of sync_track_races_today: every entity of the track card is
+    resolved with set-based SELECTs, new rows are upserted in batches and re-read by their
+    natural key to obtain their ids (races and race results before the RaceResults /
+    MappedHorseOdds / RaceBetTypes rows that reference them), and the whole track is
+    committed in a single transaction. Horses, trainers and jockeys are shared across
+    tracks and are resolved separately, see _resolve_identities.
+    Returns None when the track failed and was rolled back.
+    """
+    hrn_race_cache = {}
+    race_date = hrn.race_date
+    fingerprints = get_fingerprint_store()
+    with new_session() as session:
+        try:
+            db_races = get_db_races(track_id, race_date, session=session)
+            hrn_races = dict(hrn.iter_races(track_name))
+            race_keys = {r: fingerprints.key(race_date, track_name, r) for r in hrn_races}
+            # the state file alone can be stale, e.g. after the database was restored
+            hrn_races = {
+                r: hrn_race for r, hrn_race in hrn_races.items()
+                if r not in db_races or not fingerprints.unchanged(race_keys[r], hrn_race['fingerprint'])
+            }
+            if not hrn_races:
+                return hrn_race_cache
+
+            # <---- Horses, Trainers, Jockeys ---->
+            # committed on their own before this track's transaction takes any write lock
+            runners = [runner for hrn_race in hrn_races.values() for runner in hrn_race['runners']]
+            db_horses = _resolve_identities(Horses, {x['name']: x for x in runners}, build_horse_record)
+            db_trainers = _resolve_identities(Trainers, {x['trainer']: x for x in runners}, build_trainer_record)
+            db_jockeys = _resolve_identities(Jockeys, {x['jockey']: x for x in runners}, build_jockey_record)
+
+            # <---- Races ---->
+            db_state = compare_race_count(db_races, track_name, race_count)
+            log_info(f'Today\'s races for {track_name}, are in a state of: {db_state}')
 
-    hrn = HorseRacingNation(today_label, scrape_data[today_label])
-    hrn_tracks = hrn.get_tracks()
+            for r, hrn_race in hrn_races.items():
+                if r in db_races:
+                    update_race_record(db_races[r], hrn_race)
+            new_races = [
+                build_race_record(track_id, hrn_race, race_date)
+                for r, hrn_race in hrn_races.items() if r not in db_races
+            ]
+            db_races = _upsert_and_reload(
+                session, upsert_races, new_races, lambda: get_db_races(track_id, race_date, session=session))
+
+            # <---- Race Results and Bet Types ---->
+            race_ids = [db_races[r].id for r in hrn_races]
+            race_bet_types = get_db_bet_types_for_races(race_ids, session=session)
+            db_race_results = get_db_race_results_for_races(race_ids, session=session)
+
+            new_bet_types, new_results = [], []
+            for r, hrn_race in hrn_races.items():
+                race_id = db_races[r].id
+                for x in hrn_race['betTypesAvailable']:
+                    if x not in race_bet_types[race_id]:
+                        race_bet_types[race_id][x] = None
+                        new_bet_types.append(add_new_bet_type_mapping(race_id, x))
+
+                for runner in hrn_race['runners']:
+                    horse_id = db_horses[runner['name']][0]
+                    jockey_id = db_jockeys[runner['jockey']][0]
+                    trainer_id = db_trainers[runner['trainer']][0]
+                    res_record = db_race_results[race_id].get(horse_id)
+
+                    if res_record is None:
+                        new_results.append(build_race_res_record(
+                            race_id=race_id,
+                            horse_id=horse_id,
+                            jockey_id=jockey_id,
+                            trainer_id=trainer_id,
+                            runner=runner,
+                            race_results=hrn_race['results_by_number']
+                        ))
+                    elif hrn_race['results']:
+                        update_race_res_record(
+                            db_record=res_record,
+                            jockey_id=jockey_id,
+                            trainer_id=trainer_id,
+                            runner=runner,
+                            race_results=hrn_race['results_by_number']
+                        )
+
+            upsert_bet_types([as_row(record) for record in new_bet_types], session)
+            db_race_results = _upsert_and_reload(
+                session, upsert_race_results, new_results, lambda: get_db_race_results_for_races(race_ids, session=session))
+
+            # <---- Odds ---->
+            mapped_odds = get_mapped_odds_for_races(race_ids, session=session)
+            new_odds = []
+            for r, hrn_race in hrn_races.items():
+                race_id = db_races[r].id
+                for runner in hrn_race['runners']:
+                    horse_id = db_horses[runner['name']][0]
+                    if horse_id in mapped_odds[race_id]:
+                        continue
+                    mapped_odds[race_id][horse_id] = None
+                    new_odds.append(build_horse_odds(
+                        db_horse_id=horse_id,
+                        db_race_id=race_id,
+                        result_id=db_race_results[race_id][horse_id].id,
+                        ha_odds='',
+                        ha_status=hrn_race['status']
+                    ))
+            upsert_horse_odds([as_row(record) for record in new_odds], session)
+
+            session.commit()
+            for r, hrn_race in hrn_races.items():
+                fingerprints.update(race_keys[r], hrn_race['fingerprint'])
+            log_debug(f'{track_name}: {len(new_races)} new races, {len(new_results)} new results, {len(new_odds)} new odds')
+
+        except Exception as e:
+            session.rollback()
+            log_error(f'Critical Error: {e}')
+            return None
+
+    return hrn_race_cache
 
-     # <---- Process Tracks ---->
-    log_info('Processing Race Tracks')
-    track_info = { x['name'] : {'race_count' : x['raceCount'] }  for x in hrn_tracks}
-    sync_tracks(track_info)
-    log_success('Races Tracks Processed!')
 
+def _sync_track(hrn, track_name, track_id, race_count):
+    if DB_SYNC_MODE == 'batched':
+        return sync_track_races_batched(hrn, track_name, track_id, race_count)
+    return sync_track_races_today(hrn, track_name, track_id, race_count)
 
+
+def main(race_date=None):
+    """
+    Scrapes a day (today by default) and syncs it, track page by track page
+    :param race_date: YYYY-MM-DD
+    :type race_date: str
+    """
+    race_date = race_date or today_label()
+    log_warn(f"RUNNING IN DEBUG: {DEBUG}")
+    require_database()
+
+    # Each track page is synced as soon as it is parsed, with HRN_FETCH_WORKERS > 1
+    # the following pages keep downloading in the background meanwhile
     log_info('Processing Races')
-    # <----- Process Races ------------>
     all_races = []
-    for track in track_info:
-        if not track_info[track]['id']:
-            log_error(f'track missing from Databse: {track}')
-            continue
-
-        if 'Camarero' in track:
-            log_debug('skipping Camarero, page data in inconsistent')
+    pages = 0
+    executor = ThreadPoolExecutor(max_workers=DB_SYNC_WORKERS) if DB_SYNC_WORKERS > 1 else None
+    pending = deque()
+
+    # with a staging queue, pages are only staged here and a background flusher syncs them
+    flusher = None
+    if QUEUE_PATH:
+        staging = StagingQueue(QUEUE_PATH)
+        flusher = Flusher(staging, sync_tracks, sync_track_races_batched, prefetch=prefetch_cards)
+        flusher.start()
+
+    for datekey, t_link, races in iter_track_pages([race_date]):
+        grouped = group_races(races)
+        hrn = HorseRacingNation(race_date, grouped)
+        hrn_tracks = hrn.get_tracks()
+        if ARCHIVE_DIR:
+            archive_page(datekey, races, ARCHIVE_DIR)
+
+        if flusher:
+            for track, by_number in grouped.items():
+                staging.put(datekey, track, list(by_number.values()))
+            pages += 1
+            if DEBUG and pages == 2:
+                break
             continue
 
-        t_name = track
-        t_id = track_info[track]['id']
-        t_count = track_info[track]['race_count']
-        log_blue(f'Syncing Traces for Track : {t_name} : Races :{t_count}')
-        track_races = sync_track_races_today(hrn, t_name, t_id, t_count)
-        all_races.append(track_races)
-
+        # <---- Process Tracks ---->
+        track_info = { x['name'] : {'race_count' : x['raceCount'] }  for x in hrn_tracks}
+        sync_tracks(track_info)
+
+        # <----- Process Races ------------>
+        for track in track_info:
+            if not track_info[track]['id']:
+                log_error(f'track missing from Databse: {track}')
+                continue
+
+            if 'Camarero' in track:
+                log_debug('skipping Camarero, page data in inconsistent')
+                continue
+
+            t_name = track
+            t_id = track_info[track]['id']
+            t_count = track_info[track]['race_count']
+            log_blue(f'Syncing Traces for Track : {t_name} : Races :{t_count}')
+            if executor:
+                pending.append(executor.submit(sync_track_races_batched, hrn, t_name, t_id, t_count))
+                while len(pending) > DB_SYNC_WORKERS * 2:
+                    all_races.append(pending.popleft().result())
+            else:
+                all_races.append(_sync_track(hrn, t_name, t_id, t_count))
+
+        pages += 1
+        if DEBUG and pages == 2:
+            break
+
+    while pending:
+        all_races.append(pending.popleft().result())
+    if executor:
+        executor.shutdown()
+    if flusher:
+        flusher.stop(QUEUE_DRAIN_TIMEOUT)
+
+    log_info(f'Scrapping complete: {pages} track pages')
+    fingerprints = get_fingerprint_store()
+    fingerprints.save()
+    fingerprints.summary()
+    get_metrics().export()
     log_success('Races Processed')
     print('Run Complete')
 
 def test_main():
-    scrape_data = horse_racing_scrape([today_label], debug=True)
-    hrn = HorseRacingNation(today_label, scrape_data[today_label])
+    race_date = today_label()
+    scrape_data = horse_racing_scrape([race_date], debug=True)
+    hrn = HorseRacingNation(race_date, scrape_data[race_date])
     hrn_tracks = hrn.get_tracks()
     race_1 = hrn.get_race(hrn_tracks[0]['name'], str(1))
     print(hrn_tracks)
@@ -242,4 +512,5 @@ def test_main():
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'Prod' :
         DEBUG = False
+    set_log_level('DEBUG')
     main()
\ No newline at end of file
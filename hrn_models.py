@@ -0,0 +1,124 @@
+"""
+Compact typed representation of a HorseRacingNation race
+
+A Race is built once from the scraped tables and carries dict indexes of its
+runners by horse name and program number, and of its results by program number.
+to_dict() produces the plain dict shape the DB sync code consumes, including
+a content fingerprint used to skip races that did not change since the last sync.
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime
+
+
+def race_fingerprint(race):
+    """
+    Stable content hash of a normalized race dict (HorseRacingNation.get_race),
+    derived keys such as the fingerprint itself and results_by_number are ignored
+    """
+    content = {k: v for k, v in race.items() if k not in ('fingerprint', 'results_by_number')}
+    blob = json.dumps(content, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class Runner():
+    __slots__ = ('name', 'number', 'sire', 'trainer', 'jockey', 'morningLine', 'scratched')
+    name: str
+    number: int
+    sire: str
+    trainer: str
+    jockey: str
+    morningLine: str
+    scratched: bool
+
+    def to_dict(self):
+        return {
+            'number': self.number,
+            'name': self.name,
+            'sire': self.sire,
+            'trainer': self.trainer,
+            'jockey': self.jockey,
+            'morningLine': self.morningLine,
+            'scratched': self.scratched,
+        }
+
+
+@dataclass
+class Result():
+    __slots__ = ('name', 'number', 'win', 'place', 'show', 'fin_place')
+    name: str
+    number: int
+    win: str
+    place: str
+    show: str
+    fin_place: int
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'number': self.number,
+            'Win': self.win,
+            'Place': self.place,
+            'Show': self.show,
+            'fin_place': self.fin_place,
+        }
+
+
+@dataclass
+class Race():
+    __slots__ = (
+        'raceNumber', 'race_date', 'off_at_time_est', 'estimatedStartTime', 'status', 'distance',
+        'raceClass', 'surface', 'purse', 'betTypesAvailable', 'betTypesCompleted', 'fractional_times',
+        'runners', 'results', 'runners_by_name', 'runners_by_number', 'results_by_number'
+    )
+    raceNumber: int
+    race_date: datetime
+    off_at_time_est: str
+    estimatedStartTime: datetime
+    status: str
+    distance: str
+    raceClass: str
+    surface: str
+    purse: str
+    betTypesAvailable: list
+    betTypesCompleted: list
+    fractional_times: str
+    runners: list
+    results: list
+    runners_by_name: dict
+    runners_by_number: dict
+    results_by_number: dict
+
+    @staticmethod
+    def index(items, attr):
+        """Maps getattr(item, attr) -> item, the first item wins on duplicates"""
+        idx = {}
+        for item in items:
+            idx.setdefault(getattr(item, attr), item)
+        return idx
+
+    def to_dict(self):
+        runners = [r.to_dict() for r in self.runners]
+        results = [r.to_dict() for r in self.results]
+        race = {
+            'raceNumber': self.raceNumber,
+            'runners': runners,
+            'race_date': self.race_date,
+            'off_at_time_est': self.off_at_time_est,
+            'estimatedStartTime': self.estimatedStartTime,
+            'status': self.status,
+            'distance': self.distance,
+            'raceClass': self.raceClass,
+            'surface': self.surface,
+            'purse': self.purse,
+            'betTypesAvailable': list(self.betTypesAvailable),
+            'betTypesCompleted': list(self.betTypesCompleted),
+            'results': results,
+            'results_by_number': {r['number']: r for r in results},
+            'fractional_times': self.fractional_times,
+        }
+        race['fingerprint'] = race_fingerprint(race)
+        return race
@@ -0,0 +1,226 @@
+"""
+Disk backed HTTP response cache for HorseRacingNation pages
+
+Bodies are stored in a small SQLite file together with their ETag/Last-Modified
+validators. Each url falls in a class with its own TTL:
+
+    index        /entries-results (the day navigation)
+    live         pages for today or a future date
+    finished     pages for a date before today (US/Eastern). Served from disk forever
+                 once stored after the race day ended, HRN_HTTP_CACHE_FINISHED_MARGIN
+                 hours past its midnight, otherwise revalidated like a live page
+
+Expired entries are revalidated with a conditional GET, a 304 refreshes the
+entry without downloading the body again. The store is bounded by size and
+evicts the least recently used entries first.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from utils import log_debug
+
+CACHE_DIR = os.getenv("HRN_HTTP_CACHE", "")
+CACHE_MAX_BYTES = int(os.getenv("HRN_HTTP_CACHE_MAX_MB", 256)) * 1024 * 1024
+INDEX_TTL = int(os.getenv("HRN_HTTP_CACHE_INDEX_TTL", 300))
+LIVE_TTL = int(os.getenv("HRN_HTTP_CACHE_LIVE_TTL", 60))
+# late west coast cards finish after midnight Eastern
+FINISHED_MARGIN = float(os.getenv("HRN_HTTP_CACHE_FINISHED_MARGIN", 4))
+
+_EASTERN = pytz.timezone('US/Eastern')
+
+_DATE_RE = re.compile(r'/(\d{4}-\d{2}-\d{2})(?:[/?#]|$)')
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def url_class(url, today=None):
+    """
+    Classifies a url for TTL purposes
+    :param url: Absolute url of the page
+    :type url: str
+    :param today: Date used to decide if a page is finished, defaults to today in US/Eastern
+    :type today: date
+    :return: One of 'index', 'live' or 'finished'
+    :rtype: str
+    """
+    match = _DATE_RE.search(url)
+    if not match:
+        return 'index'
+
+    today = today or datetime.now(_EASTERN).date()
+    if match.group(1) < today.strftime("%Y-%m-%d"):
+        return 'finished'
+    return 'live'
+
+
+def finished_after(race_date):
+    """
+    Epoch time from which a page of race_date can no longer change: the end of the
+    day in US/Eastern plus FINISHED_MARGIN hours
+    :param race_date: YYYY-MM-DD
+    :type race_date: str
+    :rtype: float
+    """
+    midnight = datetime.strptime(race_date, "%Y-%m-%d") + timedelta(days=1)
+    return (_EASTERN.localize(midnight) + timedelta(hours=FINISHED_MARGIN)).timestamp()
+
+
+def url_ttl(url, stored_at=None):
+    """
+    Returns the freshness lifetime of url in seconds, None means it never expires.
+    A finished page only never expires when it was stored after its day ended,
+    a copy taken while races were still running is revalidated like a live page.
+    """
+    kind = url_class(url)
+    if kind == 'finished':
+        if stored_at is not None and stored_at >= finished_after(_DATE_RE.search(url).group(1)):
+            return None
+        return LIVE_TTL
+    return {'index': INDEX_TTL, 'live': LIVE_TTL}[kind]
+
+
+class ResponseCache():
+    """SQLite store of GET responses, bounded by total body size (LRU eviction)"""
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES):
+        os.makedirs(path, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'responses.sqlite'), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " url TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, etag TEXT,"
+            " last_modified TEXT, stored_at REAL, accessed_at REAL, size INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed_at)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, headers, body, etag, last_modified, stored_at FROM responses WHERE url = ?",
+                (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+
+        status, headers, body, etag, last_modified, stored_at = row
+        return {
+            'status': status,
+            'headers': json.loads(headers),
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': stored_at,
+        }
+
+    def put(self, url, response):
+        body = response.content
+        headers = dict(response.headers)
+        # validators are read from the case-insensitive headers, servers may send them lowercase
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, response.status_code, json.dumps(headers), body, etag, last_modified, now, now, len(body))
+            )
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def touch(self, url):
+        """Marks a revalidated (304) entry as fresh again"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self._db.commit()
+
+    def _evict(self):
+        while self._size > self._max_bytes:
+            row = self._db.execute("SELECT url, size FROM responses ORDER BY accessed_at LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM responses WHERE url = ?", (row[0],))
+            self._size -= row[1]
+            log_debug('http cache evicted: %s', row[0])
+
+
+def build_response(url, entry):
+    """Rebuilds a requests.Response from a cache entry"""
+    response = requests.Response()
+    response.url = url
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['body']
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.from_cache = True
+    return response
+
+
+class CachedSession(requests.Session):
+    """requests.Session that answers GETs from a ResponseCache when it can"""
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != 'GET':
+            return super().request(method, url, *args, **kwargs)
+
+        entry = self.cache.get(url)
+        if entry is not None:
+            ttl = url_ttl(url, entry['stored_at'])
+            if ttl is None or (time.time() - entry['stored_at']) < ttl:
+                log_debug('http cache hit: %s', url)
+                return build_response(url, entry)
+
+            headers = dict(kwargs.pop('headers', None) or {})
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            kwargs['headers'] = headers
+
+        response = super().request(method, url, *args, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            log_debug('http cache revalidated: %s', url)
+            self.cache.touch(url)
+            return build_response(url, entry)
+
+        if response.status_code == 200:
+            self.cache.put(url, response)
+        response.from_cache = False
+        return response
+
+
+def get_response_cache():
+    """
+    Returns the process wide ResponseCache, or None when HRN_HTTP_CACHE is unset
+    """
+    global _cache
+    if not CACHE_DIR:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(CACHE_DIR)
+    return _cache
@@ -0,0 +1,207 @@
+"""
+Polite HTTP transport for the scraper sessions
+
+Every session built by utils.fetch_session / fetch_thread_session sends its
+requests through a ClientAdapter, which adds to the plain requests adapter:
+
+    rate limit   a token bucket per host, shared by all sessions and threads of the
+                 process: HRN_HTTP_RATE requests/s with bursts of HRN_HTTP_BURST (0 disables it)
+    timeouts     (HRN_HTTP_CONNECT_TIMEOUT, HRN_HTTP_READ_TIMEOUT) seconds unless the caller passes one
+    retries      connection errors, timeouts, 429 and 5xx are retried HRN_HTTP_RETRIES times,
+                 backing off HRN_HTTP_BACKOFF doubling up to HRN_HTTP_BACKOFF_MAX seconds,
+                 or as long as the Retry-After header asks (capped at HRN_HTTP_RETRY_AFTER_MAX)
+    pooling      HRN_HTTP_POOL_SIZE keep-alive connections per host
+
+A 429 also pauses the bucket of its host, so every worker backs off together
+instead of each one finding out on its own. Cache hits of CachedSession never
+reach the adapter and so are neither throttled nor counted. Every attempt is
+timed as http_request, retries and throttled responses are counted.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics, incr
+from utils import log_debug, log_warn
+
+HTTP_RATE = float(os.getenv("HRN_HTTP_RATE", 4))
+HTTP_BURST = int(os.getenv("HRN_HTTP_BURST", 8))
+CONNECT_TIMEOUT = float(os.getenv("HRN_HTTP_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.getenv("HRN_HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = int(os.getenv("HRN_HTTP_RETRIES", 3))
+BACKOFF = float(os.getenv("HRN_HTTP_BACKOFF", 1))
+BACKOFF_MAX = float(os.getenv("HRN_HTTP_BACKOFF_MAX", 30))
+RETRY_AFTER_MAX = float(os.getenv("HRN_HTTP_RETRY_AFTER_MAX", 120))
+POOL_SIZE = int(os.getenv("HRN_HTTP_POOL_SIZE", 10))
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket():
+    """Thread safe token bucket, rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available
+        :return: Seconds spent waiting
+        :rtype: float
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = self._wait_time()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Holds every caller back for seconds, e.g. after the host answered 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def get_bucket(host, rate=HTTP_RATE, burst=HTTP_BURST):
+    """
+    Returns the process wide bucket of host, or None when rate limiting is disabled
+    """
+    if rate <= 0:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket(rate, burst)
+    return bucket
+
+
+def retry_after(response):
+    """
+    Seconds asked for by the Retry-After header of response, None when absent or unparsable
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def backoff_delay(attempt, response=None):
+    """
+    Delay before retry number attempt (0 based), honoring Retry-After when the response has one
+    """
+    delay = min(BACKOFF * 2 ** attempt, BACKOFF_MAX)
+    # jitter keeps the workers that failed together from retrying together
+    delay *= random.uniform(0.5, 1)
+    asked = retry_after(response) if response is not None else None
+    if asked is not None:
+        delay = max(delay, min(asked, RETRY_AFTER_MAX))
+    return delay
+
+
+class ClientAdapter(HTTPAdapter):
+    """HTTPAdapter with per host rate limiting, default timeouts and retries with backoff"""
+
+    def __init__(self, retries=HTTP_RETRIES, pool_size=POOL_SIZE, **kwargs):
+        kwargs.setdefault('pool_connections', pool_size)
+        kwargs.setdefault('pool_maxsize', pool_size)
+        super().__init__(**kwargs)
+        self.retries = retries
+
+    def _attempt(self, request, bucket, **kwargs):
+        if bucket is not None:
+            waited = bucket.acquire()
+            if waited:
+                get_metrics().observe('http_throttle_wait', waited)
+        start = time.perf_counter()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            get_metrics().observe('http_request', time.perf_counter() - start)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        host = urlsplit(request.url).netloc
+        bucket = get_bucket(host)
+
+        attempt = 0
+        while True:
+            try:
+                response = self._attempt(request, bucket, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt)
+                log_warn(f'{request.url} failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s')
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = backoff_delay(attempt, response)
+                if response.status_code == 429:
+                    incr('http_throttled')
+                    if bucket is not None:
+                        bucket.pause(delay)
+                log_warn(f'{request.url} answered {response.status_code}, retry {attempt + 1} in {delay:.1f}s')
+                response.close()
+
+            incr('retries')
+            attempt += 1
+            time.sleep(delay)
+            log_debug('retrying %s (attempt %s)', request.url, attempt + 1)
+
+
+def configure_session(session, adapter=None):
+    """
+    Mounts a ClientAdapter on session and asks for compressed, kept-alive responses
+    :param session: The session to configure
+    :type session: requests.Session
+    :param adapter: Adapter to mount instead of a default ClientAdapter
+    :type adapter: requests.adapters.HTTPAdapter
+    :return: The same session
+    :rtype: requests.Session
+    """
+    adapter = adapter or ClientAdapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Connection'] = 'keep-alive'
+    return session
@@ -0,0 +1,159 @@
+"""
+Per-stage timers and counters of a scrape / sync run
+
+Stages time themselves with timer() or @timed, volumes are counted with incr().
+At the end of a run export() writes the summary to HRN_METRICS_FILE, either as
+JSON or in the Prometheus textfile collector format (HRN_METRICS_FORMAT, or a
+.prom file extension), so a run whose duration regresses can be alerted on.
+
+    counters   pages, bytes, races, runners, queries, commits, retries, ...
+    timers     http_fetch, http_request, html_parse, race_frames, normalize, db_sync_track, ...
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+from utils import log_info
+
+METRICS_FILE = os.getenv("HRN_METRICS_FILE", "")
+METRICS_FORMAT = os.getenv("HRN_METRICS_FORMAT", "")
+METRICS_PREFIX = os.getenv("HRN_METRICS_PREFIX", "hrn")
+
+# always exported, even when a run never touched them, so alerts see a 0 rather than no series
+COUNTERS = ['pages', 'bytes', 'http_cache_hits', 'http_throttled', 'races', 'runners', 'queries', 'commits',
+            'retries']
+
+_metrics = None
+
+
+class Metrics():
+    """Thread safe counters and timers (calls, total and max seconds) of one run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = {name: 0 for name in COUNTERS}
+            self.timers = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            stat = self.timers.get(name)
+            if stat is None:
+                stat = self.timers[name] = {'count': 0, 'seconds': 0.0, 'max': 0.0}
+            stat['count'] += 1
+            stat['seconds'] += seconds
+            stat['max'] = max(stat['max'], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Snapshot of the run so far
+        :return: started, duration_seconds, counters and timers
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'duration_seconds': round(time.time() - self.started, 3),
+                'counters': dict(self.counters),
+                'timers': {k: dict(v, seconds=round(v['seconds'], 6), max=round(v['max'], 6))
+                           for k, v in self.timers.items()},
+            }
+
+    def to_prometheus(self, prefix=METRICS_PREFIX):
+        summary = self.summary()
+        lines = [
+            f'# TYPE {prefix}_run_duration_seconds gauge',
+            f'{prefix}_run_duration_seconds {summary["duration_seconds"]}',
+            f'# TYPE {prefix}_run_last_timestamp_seconds gauge',
+            f'{prefix}_run_last_timestamp_seconds {time.time():.0f}',
+        ]
+        for name, value in sorted(summary['counters'].items()):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+
+        for metric, field in (('calls_total', 'count'), ('seconds_total', 'seconds'), ('seconds_max', 'max')):
+            lines.append(f'# TYPE {prefix}_stage_{metric} gauge')
+            for stage, stat in sorted(summary['timers'].items()):
+                lines.append(f'{prefix}_stage_{metric}{{stage="{stage}"}} {stat[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path=METRICS_FILE, fmt=METRICS_FORMAT):
+        """
+        Logs the run summary and writes it to path, atomically so a textfile collector never reads half a file
+        :param path: Output file, empty only logs
+        :type path: str
+        :param fmt: 'json' or 'prom', defaults from the file extension
+        :type fmt: str
+        :return: The summary
+        :rtype: dict
+        """
+        summary = self.summary()
+        log_info('Run metrics: %s', json.dumps(summary))
+        if not path:
+            return summary
+
+        fmt = fmt or ('prom' if path.endswith('.prom') else 'json')
+        if fmt not in ('json', 'prom'):
+            raise ValueError(f'Unknown metrics format: {fmt}, use json or prom')
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus() if fmt == 'prom' else json.dumps(summary, indent=2))
+        os.replace(tmp, path)
+        return summary
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def incr(name, value=1):
+    get_metrics().incr(name, value)
+
+
+def timer(name):
+    return get_metrics().timer(name)
+
+
+def timed(name):
+    """Decorator timing every call of the function under name"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_engine(engine):
+    """Counts the statements and commits going through a SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    event.listen(engine, 'before_cursor_execute', lambda *args: incr('queries'))
+    event.listen(engine, 'commit', lambda *args: incr('commits'))
+    return engine
@@ -0,0 +1,148 @@
+"""
+Schema migration: integer id columns on race_results, dedupe, indexes and unique keys
+
+Run once against an existing database (same DB_* environment variables as hrn_driver):
+
+    python migrate_schema.py            apply
+    python migrate_schema.py --dry-run  only report what would change
+
+Steps, each safe to re-run:
+    1. race_results.horse_id / jockey_id / trainer_id become INTEGER (MySQL only)
+    2. duplicate horses, jockeys, trainers and races are merged into the lowest id,
+       rows referencing the duplicates are re-pointed first
+    3. duplicate race_results, mapped_race_bet_types and mapped_res_horse_odds rows are dropped
+    4. every index declared in Models is created if missing
+
+Duplicates are found by the database itself (GROUP BY the natural key), so the
+column collation decides what is equal, e.g. 'Smith' and 'SMITH ' on MySQL's
+case insensitive, PAD SPACE collations, the same way the unique indexes will.
+
+The migration runs in one transaction, but on MySQL every ALTER TABLE and
+CREATE INDEX commits implicitly: it is not atomic there, an interrupted run
+leaves the steps before the failure applied. Every step is re-runnable, run it
+again once the cause is fixed.
+"""
+
+import argparse
+import os
+
+from sqlalchemy import and_, delete, func, inspect, select, text, update
+from sqlalchemy.types import Integer as IntegerType
+
+from db_utils import chunked, get_engine
+from Models import *
+from utils import log_info, log_success, log_warn, set_log_level
+
+# entity -> (natural key, [(table, referencing column), ...])
+MERGES = [
+    (Horses, ('name',), [(RaceResults, 'horse_id'), (MappedHorseOdds, 'fk_horse_id')]),
+    (Jockeys, ('name',), [(RaceResults, 'jockey_id')]),
+    (Trainers, ('name',), [(RaceResults, 'trainer_id')]),
+    (Races, ('fk_track_id', 'race_date', 'race_num'), [
+        (RaceResults, 'race_id'), (MappedHorseOdds, 'fk_race_id'), (RaceBetTypes, 'fk_race_id')]),
+    (RaceResults, ('race_id', 'horse_id'), [(MappedHorseOdds, 'fk_res_horse_id')]),
+    (RaceBetTypes, ('fk_race_id', 'bet_type'), []),
+    (MappedHorseOdds, ('fk_race_id', 'fk_horse_id'), []),
+]
+
+
+def fix_result_columns(conn, dry_run):
+    if conn.dialect.name != 'mysql':
+        log_info(f'Skipping column type changes on {conn.dialect.name}')
+        return
+
+    columns = {c['name']: c['type'] for c in inspect(conn).get_columns('race_results')}
+    for name in ('horse_id', 'jockey_id', 'trainer_id'):
+        if isinstance(columns[name], IntegerType):
+            continue
+
+        log_warn(f'race_results.{name} is {columns[name]}, converting to INTEGER')
+        if dry_run:
+            continue
+        if 'DATE' in str(columns[name]).upper():
+            # a date value cannot be an id, clear it rather than cast it to a timestamp number
+            conn.execute(text(f'UPDATE race_results SET {name} = NULL'))
+        else:
+            conn.execute(text(f"UPDATE race_results SET {name} = NULL WHERE {name} NOT REGEXP '^[0-9]+$'"))
+        conn.execute(text(f'ALTER TABLE race_results MODIFY {name} INT NULL'))
+
+
+def find_duplicates(conn, model, key):
+    """
+    Returns {duplicate id: kept id}, the lowest id of each natural key is kept.
+    Keys are grouped and compared in SQL, under the collation of their columns.
+    """
+    cols = [getattr(model, c) for c in key]
+    groups = (
+        select(func.min(model.id).label('kept'), *cols)
+        .where(*[col.isnot(None) for col in cols])
+        .group_by(*cols)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    stmt = (
+        select(model.id, groups.c.kept)
+        .join(groups, and_(*[col == groups.c[col.name] for col in cols]))
+        .where(model.id != groups.c.kept)
+    )
+    return {dup: kept for dup, kept in conn.execute(stmt)}
+
+
+def merge_duplicates(conn, model, key, references, dry_run):
+    duplicates = find_duplicates(conn, model, key)
+    log_info(f'{model.__tablename__}: {len(duplicates)} duplicate rows on {key}')
+    if dry_run or not duplicates:
+        return len(duplicates)
+
+    by_kept = {}
+    for dup, kept in duplicates.items():
+        by_kept.setdefault(kept, []).append(dup)
+
+    for ref_model, column in references:
+        col = getattr(ref_model, column)
+        for kept, dups in by_kept.items():
+            for chunk in chunked(dups):
+                conn.execute(update(ref_model).where(col.in_(chunk)).values({column: kept}))
+
+    for chunk in chunked(duplicates):
+        conn.execute(delete(model).where(model.id.in_(chunk)))
+    return len(duplicates)
+
+
+def create_indexes(conn, dry_run):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            log_info(f'Creating index {index.name} on {table.name}')
+            if not dry_run:
+                index.create(bind=conn)
+
+
+def migrate(engine, dry_run=False):
+    """Applies every step in one transaction, not atomic on MySQL (DDL commits implicitly)"""
+    with engine.begin() as conn:
+        fix_result_columns(conn, dry_run)
+        for model, key, references in MERGES:
+            merge_duplicates(conn, model, key, references, dry_run)
+        create_indexes(conn, dry_run)
+    log_success('Dry run complete' if dry_run else 'Migration complete')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dedupe data and add indexes / unique keys')
+    parser.add_argument('--dry-run', action='store_true', help='report changes without applying them')
+    args = parser.parse_args()
+
+    set_log_level('INFO')
+    engine = get_engine(
+        os.getenv("DB_NAME"), os.getenv("DB_TYPE"), os.getenv("DB_ADDRESS"),
+        os.getenv("DB_USERNAME"), os.getenv("DB_PASSWORD"), os.getenv("DB_PORT", 3306)
+    )
+    migrate(engine, dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Columnar Parquet archive of scraped cards
+
+Every track page of a day is written as one Parquet file per table, partitioned
+by date and track:
+
+    <HRN_ARCHIVE_DIR>/date=2022-07-18/track=saratoga/races.parquet
+                                                     entries.parquet
+                                                     results.parquet
+                                                     also_rans.parquet
+                                                     bet_types.parquet
+                                                     pools.parquet
+
+races carries the race header plus the normalized status, post time and
+fingerprint, the other tables hold the scraped rows with their race number. The
+loaders rebuild the extract_race records, the HorseRacingNation input, with
+memory-mapped reads, so a past day can be synced or analysed again without
+fetching it. pyarrow is only imported when the archive is used.
+"""
+
+import os
+import re
+
+from horseracing_scrape import ENTRY_COLUMNS, RUNNER_COLUMNS, group_races
+from horseracingnation import HorseRacingNation
+from utils import log_debug, log_info
+
+ARCHIVE_DIR = os.getenv("HRN_ARCHIVE_DIR", "")
+
+AP_FIELDS = ['Race Time', 'Length', 'Surface', 'Race Class', 'Sex', 'Age', 'Purse', 'Bet Types', '#']
+POOL_COLUMNS = ['Pool', 'Finish', '$2 Payout', 'Total Pool', 'Fraction time']
+
+# table -> (columns written from the race records, arrow type names)
+TABLES = {
+    'races': (['race_number', 'track', 'has_results', 'has_also_rans', 'has_pools', 'status',
+               'estimated_start', 'fingerprint'] + AP_FIELDS,
+              {'has_results': 'bool', 'has_also_rans': 'bool', 'has_pools': 'bool',
+               'estimated_start': 'timestamp', '#': 'int32'}),
+    'entries': (['race_number'] + ENTRY_COLUMNS, {'#': 'bool'}),
+    'results': (['race_number'] + RUNNER_COLUMNS, {}),
+    'also_rans': (['race_number', 'Also Rans'], {}),
+    'bet_types': (['race_number', 'Bet Types', '#'], {'#': 'int32'}),
+    'pools': (['race_number'] + POOL_COLUMNS, {}),
+}
+
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('The Parquet archive needs pyarrow, pip install pyarrow') from None
+    return pyarrow, pyarrow.parquet
+
+
+def track_slug(track_name):
+    return re.sub(r'[^a-z0-9]+', '-', track_name.lower()).strip('-')
+
+
+def track_dir(race_date, track_name, root=ARCHIVE_DIR):
+    return os.path.join(root, f'date={race_date}', f'track={track_slug(track_name)}')
+
+
+def _schema(pa, table):
+    columns, types = TABLES[table]
+    arrow_types = {'bool': pa.bool_(), 'int32': pa.int32(), 'timestamp': pa.timestamp('s')}
+    return pa.schema([(c, arrow_types.get(types.get(c), pa.string())) for c in columns])
+
+
+def _rows(race_date, track_name, by_number):
+    """Splits one track's race records into rows of every table"""
+    hrn = HorseRacingNation(race_date, {track_name: by_number})
+    rows = {table: [] for table in TABLES}
+    for number, race in hrn.iter_races(track_name):
+        record = by_number[number]
+        ap = record['ap']
+        rows['races'].append(dict(
+            {k: ap.get(k) for k in AP_FIELDS},
+            race_number=number,
+            track=track_name,
+            has_results=record['runners'] is not None,
+            has_also_rans=record['also_ran'] is not None,
+            has_pools=record['pool'] is not None,
+            status=race['status'],
+            estimated_start=race['estimatedStartTime'],
+            fingerprint=race['fingerprint'],
+        ))
+        for table, key in (('entries', 'race_results'), ('results', 'runners'), ('also_rans', 'also_ran'),
+                           ('bet_types', 'bet_type'), ('pools', 'pool')):
+            for item in record[key] or []:
+                rows[table].append(dict(item, race_number=number))
+    return rows
+
+
+def archive_track(race_date, track_name, by_number, root=ARCHIVE_DIR):
+    """
+    Writes one track's races of a day, replacing a previous archive of the same track
+    :param race_date: YYYY-MM-DD
+    :type race_date: str
+    :param track_name: Track name as scraped
+    :type track_name: str
+    :param by_number: {race_number: extract_race record}
+    :type by_number: dict
+    :return: The track partition folder
+    :rtype: str
+    """
+    pa, pq = _arrow()
+    folder = track_dir(race_date, track_name, root)
+    os.makedirs(folder, exist_ok=True)
+
+    for table, rows in _rows(race_date, track_name, by_number).items():
+        schema = _schema(pa, table)
+        columns = {name: [row.get(name) for row in rows] for name in schema.names}
+        path = os.path.join(folder, f'{table}.parquet')
+        pq.write_table(pa.table(columns, schema=schema), path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    log_debug('archived %s races of %s/%s to %s', len(by_number), race_date, track_name, folder)
+    return folder
+
+
+def archive_page(race_date, races, root=ARCHIVE_DIR):
+    """Archives the race records of a parsed track page (see iter_track_pages)"""
+    return [archive_track(race_date, track, by_number, root) for track, by_number in group_races(races).items()]
+
+
+def _read(pq, folder, table):
+    return pq.read_table(os.path.join(folder, f'{table}.parquet'), memory_map=True).to_pylist()
+
+
+def load_track(folder):
+    """
+    Rebuilds the extract_race records of one archived track partition
+    :param folder: A date=/track= partition folder
+    :type folder: str
+    :return: One extract_race dict per race, in race order
+    :rtype: list
+    """
+    _, pq = _arrow()
+    by_table = {}
+    for table in TABLES:
+        grouped = {}
+        for row in _read(pq, folder, table):
+            grouped.setdefault(row.pop('race_number'), []).append(row)
+        by_table[table] = grouped
+
+    races = []
+    for number, (header,) in sorted(by_table['races'].items(), key=lambda item: int(item[0])):
+        ap = {'Race Track': header['track'], 'Race Number': number}
+        ap.update({k: header[k] for k in AP_FIELDS if header[k] is not None})
+        races.append({
+            'ap': ap,
+            'bet_type': by_table['bet_types'].get(number, []),
+            'race_results': by_table['entries'].get(number, []),
+            'runners': by_table['results'].get(number, []) if header['has_results'] else None,
+            'also_ran': by_table['also_rans'].get(number, []) if header['has_also_rans'] else None,
+            'pool': [{k: v for k, v in row.items() if v is not None} for row in by_table['pools'].get(number, [])]
+                    if header['has_pools'] else None,
+        })
+    return races
+
+
+def archived_tracks(race_date, root=ARCHIVE_DIR):
+    """Partition folders of the tracks archived for race_date"""
+    day = os.path.join(root, f'date={race_date}')
+    if not os.path.isdir(day):
+        return []
+    return [os.path.join(day, name) for name in sorted(os.listdir(day)) if name.startswith('track=')]
+
+
+def archived_days(root=ARCHIVE_DIR):
+    if not os.path.isdir(root):
+        return []
+    return sorted(name[len('date='):] for name in os.listdir(root) if name.startswith('date='))
+
+
+def iter_archived_pages(race_date, root=ARCHIVE_DIR, skip=None):
+    """
+    Archive counterpart of iter_track_pages, yields (date, partition folder, races)
+    :param skip: Optional skip(date, partition folder) -> bool
+    :type skip: callable
+    """
+    for folder in archived_tracks(race_date, root):
+        if skip and skip(race_date, folder):
+            continue
+        yield race_date, folder, load_track(folder)
+
+
+def load_card(race_date, root=ARCHIVE_DIR):
+    """
+    Rebuilds the HorseRacingNation card of an archived day
+    :param race_date: YYYY-MM-DD
+    :type race_date: str
+    :return: The card, as if the day had just been scraped
+    :rtype: HorseRacingNation
+    """
+    races = [race for _, _, page in iter_archived_pages(race_date, root) for race in page]
+    log_info('Loaded %s archived races for %s', len(races), race_date)
+    return HorseRacingNation(race_date, group_races(races))
@@ -0,0 +1,243 @@
+"""
+Race-day polling daemon
+
+Keeps today's card in memory and only rescrapes the tracks that have a race
+near or past its post time which is not FINAL yet, the track with the earliest
+pending post time first. Each race decides when its track is due again:
+
+    more than HRN_POLL_WINDOW before post      not polled until the window opens
+    window before post .. HRN_POLL_LATE after   every HRN_POLL_NEAR seconds
+    later, until HRN_POLL_GIVE_UP after post   every HRN_POLL_FAR seconds
+    FINAL, or past the give up delay           never again
+
+The daemon exits once no race of the day is left to poll. A lock file
+(HRN_DAEMON_LOCK) keeps a second instance, e.g. started by cron, from running
+over the first one:
+
+    python race_daemon.py [Prod]
+"""
+
+import fcntl
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import hrn_driver
+from db_utils import est
+from horseracing_scrape import fetch_track_page, group_races, iter_track_pages
+from horseracingnation import HorseRacingNation
+from metrics import get_metrics
+from race_state import get_fingerprint_store
+from utils import log_blue, log_debug, log_error, log_info, log_success, log_warn, set_log_level
+
+LOCK_FILE = os.getenv("HRN_DAEMON_LOCK", ".hrn_daemon.lock")
+POLL_WINDOW = int(os.getenv("HRN_POLL_WINDOW", 600))
+POLL_NEAR = int(os.getenv("HRN_POLL_NEAR", 60))
+POLL_LATE = int(os.getenv("HRN_POLL_LATE", 1800))
+POLL_FAR = int(os.getenv("HRN_POLL_FAR", 300))
+POLL_GIVE_UP = int(os.getenv("HRN_POLL_GIVE_UP", 3 * 3600))
+# longest single sleep, keeps the daemon responsive to clock changes and signals
+MAX_SLEEP = int(os.getenv("HRN_POLL_MAX_SLEEP", 300))
+
+
+class DaemonLock():
+    """Exclusive, non blocking flock on a pid file, released when the process dies"""
+
+    def __init__(self, path=LOCK_FILE):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.path, 'a+')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.seek(0)
+            owner = self._file.read().strip()
+            self._file.close()
+            self._file = None
+            log_warn(f'{self.path} is held by pid {owner or "?"}, another daemon is running')
+            return False
+
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(os.getpid()))
+        self._file.flush()
+        return True
+
+    def release(self):
+        if self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def now_est():
+    """Current Eastern time as a naive datetime, the form of estimatedStartTime"""
+    return datetime.now(est).replace(tzinfo=None)
+
+
+class TrackSchedule():
+    """Post times and FINAL state of one track's races, and when it is due again"""
+
+    def __init__(self, name, link):
+        self.name = name
+        self.link = link
+        self.track_id = None
+        self.races = {}
+        self.last_poll = None
+
+    def update(self, hrn):
+        self.races = {
+            race['raceNumber']: (race['estimatedStartTime'], race['status'] == 'FINAL')
+            for _, race in hrn.iter_races(self.name)
+        }
+
+    def pending(self, now):
+        """Post times of the races still worth polling"""
+        return [
+            start for start, final in self.races.values()
+            if not final and now < start + timedelta(seconds=POLL_GIVE_UP)
+        ]
+
+    def next_post(self, now):
+        pending = self.pending(now)
+        return min(pending) if pending else None
+
+    def due_at(self, now):
+        """
+        When this track should be scraped next, None once every race is final or given up
+        :param now: Current Eastern time
+        :type now: datetime
+        :rtype: datetime
+        """
+        due = None
+        for start in self.pending(now):
+            opens = start - timedelta(seconds=POLL_WINDOW)
+            if now < opens:
+                race_due = opens
+            else:
+                late = now > start + timedelta(seconds=POLL_LATE)
+                interval = timedelta(seconds=POLL_FAR if late else POLL_NEAR)
+                race_due = self.last_poll + interval if self.last_poll else now
+                race_due = max(race_due, opens)
+            if due is None or race_due < due:
+                due = race_due
+        return due
+
+
+def sync_card(hrn, pages, schedules):
+    """
+    Syncs freshly parsed track pages and records their schedule
+    :param hrn: The day's card, fed with the new pages so only their races are normalized again
+    :type hrn: HorseRacingNation
+    :param pages: (track link, races) pairs
+    :type pages: list
+    :param schedules: track name -> TrackSchedule, updated in place
+    :type schedules: dict
+    """
+    now = now_est()
+    for t_link, races in pages:
+        grouped = group_races(races)
+        hrn.update(grouped)
+        track_info = {track: {'race_count': len(by_number)} for track, by_number in grouped.items()}
+        hrn_driver.sync_tracks(track_info)
+
+        for track, info in track_info.items():
+            schedule = schedules.setdefault(track, TrackSchedule(track, t_link))
+            # sync_tracks leaves no id when the database could not be read
+            schedule.track_id = info.get('id')
+            schedule.update(hrn)
+            schedule.last_poll = now
+
+            if not info.get('id'):
+                log_warn(f'track missing from Databse: {track}')
+                continue
+            if 'Camarero' in track:
+                continue
+            hrn_driver._sync_track(hrn, track, info['id'], info['race_count'])
+
+    get_fingerprint_store().save()
+
+
+def due_tracks(schedules, now):
+    """Tracks due for a rescrape, earliest pending post time first"""
+    due = [s for s in schedules.values() if (s.due_at(now) or datetime.max) <= now]
+    return sorted(due, key=lambda s: s.next_post(now))
+
+
+def load_card(hrn, race_date, schedules):
+    """
+    Scrapes and syncs the whole card once. A page that fails to sync keeps its
+    schedule and is retried by the poll loop, a failed scrape of the day is
+    retried every HRN_POLL_NEAR seconds
+    """
+    while True:
+        try:
+            for _, t_link, races in iter_track_pages([race_date]):
+                try:
+                    sync_card(hrn, [(t_link, races)], schedules)
+                except Exception as e:
+                    log_error(f'Failed to sync {t_link}: {e}')
+            return
+        except Exception as e:
+            log_error(f'Failed to load the card for {race_date}: {e}, retrying in {POLL_NEAR}s')
+            time.sleep(POLL_NEAR)
+
+
+def run(race_date=None):
+    race_date = race_date or hrn_driver.today_label()
+    schedules = {}
+    hrn = HorseRacingNation(race_date, {})
+
+    log_info(f'Loading card for {race_date}')
+    load_card(hrn, race_date, schedules)
+
+    while True:
+        now = now_est()
+        for schedule in due_tracks(schedules, now):
+            log_blue(f'Polling {schedule.name}, next post {schedule.next_post(now):%H:%M}')
+            # whatever the outcome, the track is not due again before its next interval
+            schedule.last_poll = now
+            try:
+                races = fetch_track_page(schedule.link)
+                if not races:
+                    # an error page, or the track dropped off the site: retried once due again
+                    log_warn(f'Failed to poll {schedule.name}: no races on {schedule.link}')
+                    continue
+                sync_card(hrn, [(schedule.link, races)], schedules)
+            except Exception as e:
+                log_error(f'Failed to poll {schedule.name}: {e}')
+
+        now = now_est()
+        upcoming = [d for d in (s.due_at(now) for s in schedules.values()) if d is not None]
+        if not upcoming:
+            break
+
+        wait = (min(upcoming) - now).total_seconds()
+        wait = min(max(wait, 1), MAX_SLEEP)
+        log_debug(f'{len(upcoming)} tracks pending, sleeping {wait:.0f}s')
+        time.sleep(wait)
+
+    get_fingerprint_store().summary()
+    get_metrics().export()
+    log_success(f'Every race of {race_date} is final (or given up), daemon done')
+
+
+def main(race_date=None):
+    lock = DaemonLock()
+    if not lock.acquire():
+        sys.exit(1)
+    try:
+        hrn_driver.require_database()
+        run(race_date)
+    finally:
+        lock.release()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'Prod':
+        hrn_driver.DEBUG = False
+    set_log_level('DEBUG')
+    main()
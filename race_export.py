@@ -0,0 +1,107 @@
+"""
+Flat per-race export of scraped HorseRacingNation cards
+
+Each race becomes a block of rows: the race header on the first row, then the
+bet types, entries, runners, also-rans and pools side by side, one item per row.
+Rows are written as soon as a race is parsed, one file per race date.
+"""
+
+import csv
+import os
+from itertools import zip_longest
+
+from utils import log_info
+
+AP_COLUMNS = ['Race Track', 'Race Number', 'Race Time', 'Length', 'Surface', 'Race Class', 'Sex', 'Age', 'Purse']
+FLAT_COLUMNS = AP_COLUMNS + [
+    'Bet Types', '#',
+    'PP', 'Horse', 'Sire', 'Trainer', 'Jockey', 'Morning Line ML', 'Scratched',
+    'Runner Name', 'Horse Number', 'Win', 'Place', 'Show',
+    'Also Ran',
+    'Pool', 'Finish', '$2 Payout', 'Total Pool', 'Fractions and Final time'
+]
+
+_BET_KEYS = ['Bet Types', '#']
+_ENTRY_KEYS = ['PP', 'Horse', 'Sire', 'Trainer', 'Jockey', 'ML', '#']
+_RUNNER_KEYS = ['Runner', 'Horse Number', 'Win', 'Place', 'Show']
+_ALSO_RAN_KEYS = ['Also Rans']
+_POOL_KEYS = ['Pool', 'Finish', '$2 Payout', 'Total Pool', 'Fraction time']
+
+
+def _cells(record, keys):
+    if record is None:
+        return [''] * len(keys)
+    return [record.get(k, '') for k in keys]
+
+
+def flat_rows(race_record):
+    """
+    Yields the flat rows of one extracted race (see horseracing_scrape.extract_race)
+    :param race_record: The race records
+    :type race_record: dict
+    :return: Lists of cell values, aligned with FLAT_COLUMNS
+    :rtype: generator
+    """
+    ap = race_record['ap']
+    blocks = zip_longest(
+        race_record['bet_type'],
+        race_record['race_results'],
+        race_record['runners'] or [],
+        race_record['also_ran'] or [],
+        race_record['pool'] or [],
+    )
+    for idx, (bet, entry, runner, also_ran, pool) in enumerate(blocks):
+        row = [ap.get(k, '') for k in AP_COLUMNS] if idx == 0 else [''] * len(AP_COLUMNS)
+        row += _cells(bet, _BET_KEYS)
+        row += _cells(entry, _ENTRY_KEYS)
+        row += _cells(runner, _RUNNER_KEYS)
+        row += _cells(also_ran, _ALSO_RAN_KEYS)
+        row += _cells(pool, _POOL_KEYS)
+        yield row
+
+
+class FlatRaceExporter():
+    """Writes flat race rows incrementally to <export_dir>/<date>-V3.csv or .xlsx"""
+
+    def __init__(self, race_date, fmt='csv', export_dir='.'):
+        if fmt not in ('csv', 'xlsx'):
+            raise ValueError(f'Unknown export format: {fmt}, use csv or xlsx')
+
+        os.makedirs(export_dir, exist_ok=True)
+        self.race_date = race_date
+        self.path = os.path.join(export_dir, f'{race_date}-V3.{fmt}')
+        self._fmt = fmt
+        self._rows = 0
+
+        if fmt == 'csv':
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(FLAT_COLUMNS)
+        else:
+            from openpyxl import Workbook
+
+            self._book = Workbook(write_only=True)
+            self._sheet = self._book.create_sheet(race_date)
+            self._sheet.append(FLAT_COLUMNS)
+
+    def write_race(self, race_record):
+        for row in flat_rows(race_record):
+            if self._fmt == 'csv':
+                self._writer.writerow(row)
+            else:
+                self._sheet.append(row)
+            self._rows += 1
+
+    def close(self):
+        if self._fmt == 'csv':
+            self._file.close()
+        else:
+            self._book.save(self.path)
+        log_info(f'Exported {self._rows} rows to {self.path}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
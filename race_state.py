@@ -0,0 +1,162 @@
+"""
+Local record of what was last synced, per race and per backfilled track page
+
+Each synced race stores the fingerprint of its normalized content under
+"<race date>/<track>/<race number>". A later run skips the races whose
+fingerprint did not change and that the database still has, so a database
+restored at the same address gets its missing races again. HRN_STATE_FILE names
+the JSON file, empty disables it. Fingerprints are kept per database
+(HRN_STATE_TARGET, by default built from DB_TYPE/DB_ADDRESS/DB_PORT/DB_NAME), so
+a run against another database syncs everything again. Dates older than
+HRN_STATE_KEEP_DAYS are pruned when the file is saved.
+
+A backfill checkpoints every (date, track page) it synced, and every completed
+date, in HRN_BACKFILL_STATE, so a restarted backfill resumes where it stopped.
+"""
+
+import json
+import os
+import threading
+from datetime import date, timedelta
+
+from utils import log_debug, log_info
+
+STATE_FILE = os.getenv("HRN_STATE_FILE", ".hrn_state.json")
+BACKFILL_STATE = os.getenv("HRN_BACKFILL_STATE", ".hrn_backfill.json")
+STATE_TARGET = os.getenv("HRN_STATE_TARGET") or "{}://{}:{}/{}".format(
+    os.getenv("DB_TYPE", ""), os.getenv("DB_ADDRESS", ""), os.getenv("DB_PORT", 3306), os.getenv("DB_NAME", "")
+)
+# 0 keeps every date
+STATE_KEEP_DAYS = int(os.getenv("HRN_STATE_KEEP_DAYS", 14))
+
+_store = None
+
+
+class FingerprintStore():
+    """JSON backed race fingerprints of one database, with per run skipped/changed counters"""
+
+    def __init__(self, path=STATE_FILE, target=STATE_TARGET, keep_days=STATE_KEEP_DAYS):
+        self.path = path
+        self.target = target
+        self.keep_days = keep_days
+        self.skipped = 0
+        self.changed = 0
+        self._lock = threading.Lock()
+        # database target -> {race key: fingerprint}, the other targets are only carried along
+        self._targets = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            # files written before fingerprints were kept per database are dropped, their target is unknown
+            self._targets = state.get('targets', {})
+        self._fingerprints = self._targets.setdefault(target, {})
+
+    @staticmethod
+    def key(race_date, track_name, race_number):
+        return f'{race_date}/{track_name}/{race_number}'
+
+    def unchanged(self, key, fingerprint):
+        """True when the race was synced with this exact content, counts the outcome"""
+        with self._lock:
+            same = bool(self.path) and self._fingerprints.get(key) == fingerprint
+            if same:
+                self.skipped += 1
+            else:
+                self.changed += 1
+        if same:
+            log_debug('race unchanged, skipping: %s', key)
+        return same
+
+    def update(self, key, fingerprint):
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+
+    def prune(self, today=None):
+        """
+        Drops the fingerprints of race dates older than keep_days, in every target
+        :return: Number of races dropped
+        :rtype: int
+        """
+        if not self.keep_days:
+            return 0
+        cutoff = ((today or date.today()) - timedelta(days=self.keep_days)).strftime("%Y-%m-%d")
+        dropped = 0
+        with self._lock:
+            for fingerprints in self._targets.values():
+                old = [key for key in fingerprints if key[:10] < cutoff]
+                for key in old:
+                    del fingerprints[key]
+                dropped += len(old)
+        if dropped:
+            log_debug('pruned %s race fingerprints older than %s', dropped, cutoff)
+        return dropped
+
+    def save(self):
+        if not self.path:
+            return
+        self.prune()
+        with self._lock:
+            targets = {target: fps for target, fps in self._targets.items() if fps}
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'targets': targets}, f)
+            os.replace(tmp, self.path)
+
+    def summary(self):
+        log_info(f'Races unchanged (skipped): {self.skipped}, changed (synced): {self.changed}')
+        return {'skipped': self.skipped, 'changed': self.changed}
+
+
+class BackfillCheckpoint():
+    """JSON backed set of finished dates and finished (date, track link) pairs"""
+
+    def __init__(self, path=BACKFILL_STATE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._days = set()
+        self._tracks = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self._days = set(state.get('days', []))
+            self._tracks = {day: set(links) for day, links in state.get('tracks', {}).items()}
+
+    def day_done(self, race_date):
+        with self._lock:
+            return race_date in self._days
+
+    def track_done(self, race_date, t_link):
+        with self._lock:
+            return t_link in self._tracks.get(race_date, ())
+
+    def mark_track(self, race_date, t_link):
+        with self._lock:
+            self._tracks.setdefault(race_date, set()).add(t_link)
+        self.save()
+
+    def mark_day(self, race_date):
+        with self._lock:
+            self._days.add(race_date)
+            # the day entry covers its tracks from now on
+            self._tracks.pop(race_date, None)
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                'days': sorted(self._days),
+                'tracks': {day: sorted(links) for day, links in sorted(self._tracks.items())},
+            }
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f, indent=1)
+            os.replace(tmp, self.path)
+
+
+def get_fingerprint_store():
+    global _store
+    if _store is None:
+        _store = FingerprintStore()
+    return _store
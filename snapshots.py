@@ -0,0 +1,170 @@
+"""
+Record/replay transport for HorseRacingNation pages
+
+HRN_SNAPSHOT_MODE=record   every response fetched through a session is written to the snapshot store
+HRN_SNAPSHOT_MODE=replay   responses are served from the snapshot store, no network I/O at all
+
+Snapshots live under HRN_SNAPSHOT_DIR as <date>/<sha1(url)>.gz, where date is the
+race date found in the url, or the recording date for undated pages such as the
+entries-results index. Replay of undated pages uses HRN_SNAPSHOT_DATE when set,
+otherwise the most recent recording.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+from datetime import date
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from http_client import ClientAdapter
+from utils import log_debug
+
+SNAPSHOT_MODE = os.getenv("HRN_SNAPSHOT_MODE", "")
+SNAPSHOT_DIR = os.getenv("HRN_SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_DATE = os.getenv("HRN_SNAPSHOT_DATE", "")
+
+_DATE_RE = re.compile(r'/(\d{4}-\d{2}-\d{2})(?:[/?#]|$)')
+
+
+class SnapshotStore():
+    """Compressed on-disk responses keyed by date and url"""
+
+    def __init__(self, root=SNAPSHOT_DIR, pinned_date=SNAPSHOT_DATE):
+        self.root = root
+        self.pinned_date = pinned_date
+
+    @staticmethod
+    def _name(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest() + '.gz'
+
+    @staticmethod
+    def url_date(url):
+        match = _DATE_RE.search(url)
+        return match.group(1) if match else None
+
+    def save(self, url, response):
+        key = self.url_date(url) or date.today().strftime("%Y-%m-%d")
+        folder = os.path.join(self.root, key)
+        os.makedirs(folder, exist_ok=True)
+
+        meta = {'url': url, 'status': response.status_code, 'headers': dict(response.headers)}
+        path = os.path.join(folder, self._name(url))
+        tmp = path + '.tmp'
+        with gzip.open(tmp, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(response.content)
+        os.replace(tmp, path)
+        log_debug('snapshot recorded: %s -> %s', url, path)
+
+    def _candidates(self, url):
+        key = self.url_date(url)
+        if key:
+            return [key]
+        if self.pinned_date:
+            return [self.pinned_date]
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(os.listdir(self.root), reverse=True)
+
+    def load(self, url):
+        """
+        Returns the stored snapshot for url, or None
+        :param url: Absolute url
+        :type url: str
+        :return: dict with url, status, headers and body
+        :rtype: dict
+        """
+        name = self._name(url)
+        for key in self._candidates(url):
+            path = os.path.join(self.root, key, name)
+            if os.path.exists(path):
+                with gzip.open(path, 'rb') as f:
+                    meta = json.loads(f.readline())
+                    meta['body'] = f.read()
+                return meta
+        return None
+
+    def iter_snapshots(self, key=None):
+        """Yields every stored snapshot, optionally only those of one date"""
+        keys = [key] if key else sorted(os.listdir(self.root))
+        for k in keys:
+            folder = os.path.join(self.root, k)
+            for name in sorted(os.listdir(folder)):
+                if name.endswith('.gz'):
+                    with gzip.open(os.path.join(folder, name), 'rb') as f:
+                        meta = json.loads(f.readline())
+                        meta['body'] = f.read()
+                    yield meta
+
+
+class RecordingAdapter(ClientAdapter):
+    """ClientAdapter that writes each response it receives to a SnapshotStore"""
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # send() returns a streaming response, reading it here keeps it usable for the caller
+        response.content
+        self.store.save(request.url, response)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter that answers every request from a SnapshotStore"""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def send(self, request, **kwargs):
+        snapshot = self.store.load(request.url)
+        if snapshot is None:
+            raise requests.ConnectionError(f'No snapshot recorded for {request.url}', request=request)
+
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.status_code = snapshot['status']
+        response.headers = CaseInsensitiveDict(snapshot['headers'])
+        response._content = snapshot['body']
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = 'Replayed'
+        return response
+
+    def close(self):
+        pass
+
+
+def mount_snapshots(session, mode=SNAPSHOT_MODE, store=None):
+    """
+    Mounts the record or replay adapter on session according to mode
+    :param session: The session to configure
+    :type session: requests.Session
+    :param mode: 'record', 'replay' or '' for plain network access
+    :type mode: str
+    :return: The same session
+    :rtype: requests.Session
+    """
+    if not mode:
+        return session
+
+    store = store or SnapshotStore()
+    if mode == 'record':
+        adapter = RecordingAdapter(store)
+    elif mode == 'replay':
+        adapter = ReplayAdapter(store)
+    else:
+        raise ValueError(f'Unknown snapshot mode: {mode}, use record or replay')
+
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,334 @@
+"""
+Local write-ahead staging queue between the scraper and the database
+
+With HRN_STAGING_QUEUE pointing at a file, hrn_driver no longer writes to MySQL
+while it scrapes: every parsed track card is put in a SQLite queue (WAL mode)
+and a flusher drains it into the database in batches. A slow or unreachable
+database then only delays the flush, scraping carries on and nothing is lost,
+the queue survives restarts.
+
+    one row per (race date, track)   a newer scrape of the same track replaces the
+                                     pending one, only the latest card is synced
+    backpressure                     put() waits while HRN_QUEUE_MAX_PENDING tracks are pending
+    retry                            a failed track is retried with exponential backoff,
+                                     HRN_QUEUE_RETRY_BASE doubling up to HRN_QUEUE_RETRY_MAX seconds
+    dead letters                     a track missing from the database, or still failing after
+                                     HRN_QUEUE_MAX_ATTEMPTS tries, moves to the dead_letter table
+                                     and no longer counts towards the backpressure limit
+
+The queue can also be drained on its own, e.g. after an outage, and dead
+letters put back once their cause is fixed (e.g. the track was added):
+
+    python staging_queue.py [--forever] [--requeue-dead]
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from horseracing_scrape import group_races
+from horseracingnation import HorseRacingNation
+from metrics import incr
+from utils import log_debug, log_error, log_info, log_warn, set_log_level
+
+QUEUE_PATH = os.getenv("HRN_STAGING_QUEUE", "")
+QUEUE_BATCH = int(os.getenv("HRN_QUEUE_BATCH", 50))
+QUEUE_MAX_PENDING = int(os.getenv("HRN_QUEUE_MAX_PENDING", 1000))
+QUEUE_POLL = float(os.getenv("HRN_QUEUE_POLL", 2))
+RETRY_BASE = float(os.getenv("HRN_QUEUE_RETRY_BASE", 5))
+RETRY_MAX = float(os.getenv("HRN_QUEUE_RETRY_MAX", 300))
+MAX_ATTEMPTS = int(os.getenv("HRN_QUEUE_MAX_ATTEMPTS", 20))
+
+
+class StagingQueue():
+    """Durable queue of scraped track cards, keyed by (race date, track)"""
+
+    def __init__(self, path=QUEUE_PATH, max_pending=QUEUE_MAX_PENDING, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS staged ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, race_date TEXT NOT NULL, track TEXT NOT NULL,"
+            " payload TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 1, enqueued_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL DEFAULT 0, last_error TEXT,"
+            " UNIQUE (race_date, track))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letter ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, race_date TEXT NOT NULL, track TEXT NOT NULL,"
+            " payload TEXT NOT NULL, attempts INTEGER NOT NULL, last_error TEXT, failed_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def depth(self):
+        """Cards waiting for a sync or a retry, dead letters excluded"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM staged").fetchone()[0]
+
+    def dead_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+    def put(self, race_date, track, races, wait=True):
+        """
+        Stages the race records of one track, replacing a pending card of the same track
+        :param race_date: YYYY-MM-DD
+        :type race_date: str
+        :param track: Track name as scraped
+        :type track: str
+        :param races: extract_race records of the track
+        :type races: list
+        :param wait: Block while the queue is full (backpressure)
+        :type wait: bool
+        :return: None
+        """
+        if wait and self.depth() >= self.max_pending:
+            log_warn(f'Staging queue full ({self.max_pending} tracks pending), waiting for the flusher')
+            while self.depth() >= self.max_pending:
+                time.sleep(QUEUE_POLL)
+
+        payload = json.dumps(races)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO staged (race_date, track, payload, enqueued_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (race_date, track) DO UPDATE SET payload = excluded.payload,"
+                " version = version + 1, enqueued_at = excluded.enqueued_at, attempts = 0,"
+                " next_attempt = 0, last_error = NULL",
+                (race_date, track, payload, time.time())
+            )
+            self._db.commit()
+        incr('staged_tracks')
+        log_debug('staged %s/%s (%s races)', race_date, track, len(races))
+
+    def due(self, limit=QUEUE_BATCH):
+        """Oldest pending cards whose retry delay has passed: (id, version, race_date, track, races, attempts)"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, version, race_date, track, payload, attempts FROM staged"
+                " WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+        return [(i, v, d, t, json.loads(p), a) for i, v, d, t, p, a in rows]
+
+    def done(self, entry_id, version):
+        """Removes a synced card, unless a newer scrape of the track replaced it meanwhile"""
+        with self._lock:
+            self._db.execute("DELETE FROM staged WHERE id = ? AND version = ?", (entry_id, version))
+            self._db.commit()
+
+    def failed(self, entry_id, version, attempts, error, retryable=True):
+        """
+        Schedules the retry of a card that did not sync, or moves it to the dead letters
+        when the failure is permanent or max_attempts is reached
+        :return: Seconds until the retry, None when the card was dead lettered
+        :rtype: float
+        """
+        if not retryable or attempts + 1 >= self.max_attempts:
+            with self._lock:
+                self._db.execute(
+                    "INSERT INTO dead_letter (race_date, track, payload, attempts, last_error, failed_at)"
+                    " SELECT race_date, track, payload, attempts + 1, ?, ? FROM staged WHERE id = ? AND version = ?",
+                    (str(error), time.time(), entry_id, version)
+                )
+                self._db.execute("DELETE FROM staged WHERE id = ? AND version = ?", (entry_id, version))
+                self._db.commit()
+            return None
+
+        delay = min(RETRY_BASE * 2 ** attempts, RETRY_MAX)
+        with self._lock:
+            self._db.execute(
+                "UPDATE staged SET attempts = attempts + 1, next_attempt = ?, last_error = ?"
+                " WHERE id = ? AND version = ?",
+                (time.time() + delay, str(error), entry_id, version)
+            )
+            self._db.commit()
+        return delay
+
+    def requeue_dead(self):
+        """
+        Stages every dead letter again, unless a newer card of the same track is pending
+        :return: Cards requeued
+        :rtype: int
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT id, race_date, track, payload FROM dead_letter ORDER BY id").fetchall()
+            for dead_id, race_date, track, payload in rows:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO staged (race_date, track, payload, enqueued_at) VALUES (?, ?, ?, ?)",
+                    (race_date, track, payload, time.time())
+                )
+                self._db.execute("DELETE FROM dead_letter WHERE id = ?", (dead_id,))
+            self._db.commit()
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Flusher():
+    """
+    Drains a StagingQueue into the database, one transaction per track
+    :param queue: The queue to drain
+    :type queue: StagingQueue
+    :param resolve_tracks: hrn_driver.sync_tracks, fills {track: {'id': ...}}
+    :type resolve_tracks: callable
+    :param sync_track: hrn_driver.sync_track_races_batched, returns None on failure
+    :type sync_track: callable
+    :param prefetch: Optional hrn_driver.prefetch_cards, warms the identity cache for a whole batch
+    :type prefetch: callable
+    """
+
+    def __init__(self, queue, resolve_tracks, sync_track, batch_size=QUEUE_BATCH, prefetch=None):
+        self.queue = queue
+        self.resolve_tracks = resolve_tracks
+        self.sync_track = sync_track
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sync(self, hrn, track, info):
+        """
+        :param info: The track's resolve_tracks entry, without 'id' when the database could not be read
+        :return: None when synced (or skipped on purpose), otherwise (error, retryable)
+        :rtype: tuple
+        """
+        if 'id' not in info:
+            return 'database unreachable, track not resolved', True
+        if not info['id']:
+            return 'track missing from database', False
+        if 'Camarero' in track:
+            return None
+        race_count = {t['name']: t['raceCount'] for t in hrn.get_tracks()}[track]
+        if self.sync_track(hrn, track, info['id'], race_count) is None:
+            return 'sync rolled back', True
+        return None
+
+    def flush_once(self):
+        """
+        Syncs one batch of due cards
+        :return: Number of cards synced
+        :rtype: int
+        """
+        batch = self.queue.due(self.batch_size)
+        if not batch:
+            return 0
+
+        track_info = {track: {} for _, _, _, track, _, _ in batch}
+        try:
+            self.resolve_tracks(track_info)
+        except Exception as e:
+            log_error(f'Staging flush could not resolve tracks: {e}')
+
+        cards = {entry_id: HorseRacingNation(race_date, group_races(races))
+                 for entry_id, _, race_date, _, races, _ in batch}
+        if self.prefetch:
+            self.prefetch((cards[entry_id], track) for entry_id, _, _, track, _, _ in batch
+                          if track_info[track].get('id'))
+
+        synced = 0
+        for entry_id, version, race_date, track, races, attempts in batch:
+            try:
+                failure = self._sync(cards[entry_id], track, track_info[track])
+            except Exception as e:
+                failure = e, True
+            if failure is None:
+                self.queue.done(entry_id, version)
+                synced += 1
+                continue
+
+            error, retryable = failure
+            delay = self.queue.failed(entry_id, version, attempts, error, retryable)
+            if delay is None:
+                incr('dead_lettered')
+                log_error(f'Staged {race_date}/{track} moved to the dead letters after {attempts + 1} tries: {error}')
+            else:
+                incr('sync_retries')
+                log_warn(f'Staged {race_date}/{track} not synced ({error}), retry in {delay:.0f}s')
+        incr('flushed_tracks', synced)
+        return synced
+
+    def drain(self, timeout=None):
+        """
+        Flushes until nothing is due, or until timeout seconds passed
+        :return: Cards still in the queue
+        :rtype: int
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.flush_once():
+            if deadline and time.time() > deadline:
+                break
+        return self.queue.depth()
+
+    def run(self):
+        errors = 0
+        while not self._stop.is_set():
+            try:
+                synced = self.flush_once()
+                errors = 0
+            except Exception as e:
+                # e.g. the queue file locked by another flusher, the thread must outlive it
+                delay = min(QUEUE_POLL * 2 ** errors, RETRY_MAX)
+                errors += 1
+                incr('flush_errors')
+                log_error(f'Staging flush failed ({e}), retrying in {delay:.0f}s')
+                self._stop.wait(delay)
+                continue
+            if not synced:
+                self._stop.wait(QUEUE_POLL)
+
+    def start(self):
+        """Runs the flusher in a background thread"""
+        self._thread = threading.Thread(target=self.run, name='staging-flusher', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, drain_timeout=None):
+        """
+        Stops the background thread, after draining what is due for up to drain_timeout seconds
+        :return: Cards left in the queue for the next run
+        :rtype: int
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        left = self.drain(drain_timeout)
+        if left:
+            log_warn(f'{left} staged tracks left in {self.queue.path}, they are synced by the next flush')
+        return left
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drain the staging queue into the database')
+    parser.add_argument('--path', default=QUEUE_PATH or '.hrn_queue.sqlite', help='queue file')
+    parser.add_argument('--forever', action='store_true', help='keep draining as new cards are staged')
+    parser.add_argument('--requeue-dead', action='store_true', help='stage the dead letters again first')
+    args = parser.parse_args()
+
+    import hrn_driver
+
+    set_log_level('INFO')
+    hrn_driver.require_database()
+    queue = StagingQueue(args.path)
+    if args.requeue_dead:
+        log_info(f'{queue.requeue_dead()} dead letters staged again')
+    flusher = Flusher(queue, hrn_driver.sync_tracks, hrn_driver.sync_track_races_batched,
+                      prefetch=hrn_driver.prefetch_cards)
+    if args.forever:
+        flusher.run()
+    else:
+        left = flusher.drain()
+        log_info(f'Staging queue drained, {left} tracks waiting for a retry, {queue.dead_count()} dead letters')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,27 @@
+import json
 import logging
 import os
 import sys
-import inspect
+import threading
 import requests
 from datetime import datetime
 from datetime import timedelta, time
 
 _session = None
+_thread_local = threading.local()
 
 # Avoided using the build-in "basicConfig" from logger library, because it affects botocore, and everything else
 LOGLEVELS = ["DEBUG", "INFO", "WARN", "WARNING", "ERROR", "CRITICAL"]
-_LOGLEVEL = ["WARNING", "ERROR", "CRITICAL"]
+_LEVEL_NUMBERS = {
+    "DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARN": logging.WARNING,
+    "WARNING": logging.WARNING, "ERROR": logging.ERROR, "CRITICAL": logging.CRITICAL
+}
+# numeric threshold checked before anything else, a disabled level costs one comparison
+_level = logging.WARNING
+# 'text' or 'json' (one object per line, for log pipelines)
+LOG_FORMAT = os.getenv("HRN_LOG_FORMAT", "text")
+# module name -> logger, built on first use
+_loggers = {}
 
 class bcolors:
     HEADER = '\033[95m'
@@ -37,6 +48,29 @@ def add_to_datetime(today_date, est_hour_minute):
     return datetime.combine(today_date, est_time)
 
 
+def _new_session():
+    """
+    Builds a requests session, backed by the disk response cache when
+    HRN_HTTP_CACHE points at a directory. While recording or replaying
+    snapshots (HRN_SNAPSHOT_MODE) the cache is bypassed so every request
+    reaches the snapshot transport. Network requests go through the rate
+    limited, retrying http_client transport.
+    :return: Requests session object
+    :rtype: object
+    """
+    from http_cache import CachedSession, get_response_cache
+    from http_client import configure_session
+    from snapshots import SNAPSHOT_MODE, mount_snapshots
+
+    if SNAPSHOT_MODE:
+        return mount_snapshots(configure_session(requests.Session()), SNAPSHOT_MODE)
+
+    cache = get_response_cache()
+    if cache is not None:
+        return configure_session(CachedSession(cache))
+    return configure_session(requests.Session())
+
+
 def _create_session():
     """
     Creates a requests session object
@@ -44,7 +78,7 @@ def _create_session():
     :rtype: object
     """
     global _session
-    _session = requests.Session()
+    _session = _new_session()
     return _session
 
 
@@ -60,126 +94,190 @@ def fetch_session():
     return _session
 
 
+def fetch_thread_session():
+    """
+    Returns a requests session owned by the calling thread, so concurrent
+    workers never share a connection pool
+    :return: Requests session object
+    :rtype: object
+    """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = _new_session()
+        _thread_local.session = session
+    return session
+
+
 def set_log_level(loglevel):
-    global _LOGLEVEL
-    x = LOGLEVELS
+    global _level
 
     if loglevel.upper() in LOGLEVELS:
         print(f'LOG LEVEL: {loglevel}')
-        _LOGLEVEL = x[x.index(loglevel.upper()):]
+        _level = _LEVEL_NUMBERS[loglevel.upper()]
     else:
-        print(f'Invalid Log Level, Please use :{LOGLEVELS.keys()}, defaulting to WARN')
-        logging.basicConfig(level=logging.WARN)
-
-def _channel_creator_logger(f=None, logging_level=logging.INFO, environment="dev"):
-    """
-    A generic logging handler for building out a logging facility.
-    :param name: The name of of the application running
-    :type name: str
-    :param f: The file handler
-    :type f: file
-    :param logging_level: The standard POSIX logging levels
-    :type logging_level: int
+        print(f'Invalid Log Level, Please use :{LOGLEVELS}, defaulting to WARN')
+        _level = logging.WARNING
+
+
+def set_log_format(log_format):
+    """
+    Switches every logger between colored text lines and one JSON object per line
+    :param log_format: 'text' or 'json'
+    :type log_format: str
+    :return: None
+    """
+    global LOG_FORMAT
+    if log_format not in ('text', 'json'):
+        raise ValueError(f'Unknown log format: {log_format}, use text or json')
+    LOG_FORMAT = log_format
+    _handler.setFormatter(_JsonFormatter() if log_format == 'json' else _TextFormatter())
+
+
+class _TextFormatter(logging.Formatter):
+    """The classic 'LEVEL module:function: message' line, colored through extra={'color': ...}"""
+
+    def __init__(self):
+        super().__init__('%(levelname)s %(name)s:%(funcName)s: %(message)s')
+
+    def formatMessage(self, record):
+        color = getattr(record, 'color', None)
+        if color:
+            record.message = color + record.message + bcolors.ENDC
+        return super().formatMessage(record)
+
+
+class _JsonFormatter(logging.Formatter):
+    """One JSON object per line, no color codes"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _StreamHandler(logging.Handler):
+    """
+    Writes debug/info lines to stdout, warnings, errors and highlighted lines to stderr.
+    The stream is looked up at emit time so redirected sys.stdout/sys.stderr are honored.
+    """
+
+    def emit(self, record):
+        try:
+            stream = sys.stderr if record.levelno >= logging.WARNING or getattr(record, 'color', None) else sys.stdout
+            stream.write(self.format(record) + '\n')
+            stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+_handler = _StreamHandler()
+_handler.setFormatter(_JsonFormatter() if LOG_FORMAT == 'json' else _TextFormatter())
+
+
+def _module_logger(frame):
+    """
+    Returns the cached logger of the module the frame belongs to
+    :param frame: The frame of the log_* caller
+    :type frame: frame
     :return: A logging facility
-    :rtype: cls
-    """
-    module = inspect.stack()[2]
-    mod_name, func_name = os.path.basename(module.filename), module.function.title()
-    logger_name = f"{mod_name[:-3]}:{func_name}".lower()
-    
-    logger = logging.getLogger(logger_name)
-    logger.propagate = False
-    logger_handler = logging.StreamHandler(f)
-
-    log_format = '%(levelname)s %(name)s: %(message)s'
-    formatter = logging.Formatter(log_format)
-    logger_handler.setFormatter(formatter)
-    if len(logger.handlers) == 0:
-        logger.addHandler(logger_handler)
-    logger.setLevel(logging_level)
+    :rtype: logging.Logger
+    """
+    module = frame.f_globals.get('__name__', '')
+    logger = _loggers.get(module)
+    if logger is None:
+        name = module
+        if module == '__main__':
+            name = os.path.splitext(os.path.basename(frame.f_globals.get('__file__', module)))[0]
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        if _handler not in logger.handlers:
+            logger.addHandler(_handler)
+        _loggers[module] = logger
     return logger
 
 
-def log_debug(msg):
+def log_debug(msg, *args):
     """
     log debug level messages.
-    :param msg: The message to include in the log
+    :param msg: The message to include in the log, %-style when args are given
     :type msg: str
+    :param args: Arguments merged into msg only when the line is emitted
     :return: None
     """
-    if "DEBUG" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stdout, logging_level=logging.DEBUG)
-        logger.debug(msg)
+    if _level <= logging.DEBUG:
+        _module_logger(sys._getframe(1)).debug(msg, *args, stacklevel=2)
 
 
-def log_info(msg):
+def log_info(msg, *args):
     """
     log info level message.
-    :param msg: The message to include in the log
+    :param msg: The message to include in the log, %-style when args are given
     :type msg: str
     :return: None
     """
-    if "INFO" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stdout, logging_level=logging.INFO)
-        logger.info(msg)
+    if _level <= logging.INFO:
+        _module_logger(sys._getframe(1)).info(msg, *args, stacklevel=2)
 
 
-def log_exception(msg):
+def log_exception(msg, *args):
     """
     log exception. (ERROR)
     :param msg: The message to include in the log
     :type msg: str
     :return: None
     """
-    if "ERROR" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stderr, logging_level=logging.ERROR)
-        logger.exception(msg)
+    if _level <= logging.ERROR:
+        _module_logger(sys._getframe(1)).exception(msg, *args, stacklevel=2)
 
 
-def log_error(msg):
+def log_error(msg, *args):
     """
     log red error message. 
-    :param name: The name of the log
+    :param msg: The message to include in the log
     :type msg: str
     :return: None
     """
-    if "ERROR" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stderr, logging_level=logging.ERROR)
-        logger.error(f"{bcolors.FAIL + str(msg) + bcolors.ENDC}")
+    if _level <= logging.ERROR:
+        _module_logger(sys._getframe(1)).error(msg, *args, stacklevel=2, extra={'color': bcolors.FAIL})
 
 
-def log_warn(msg):
+def log_warn(msg, *args):
     """
     log a yellow warning.
     :param msg: The message to include in the log
     :type msg: str
     :return: None
     """
-    if "WARN" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stderr, logging_level=logging.WARN)
-        logger.warn(f"{bcolors.WARNING + str(msg) + bcolors.ENDC}")
+    if _level <= logging.WARNING:
+        _module_logger(sys._getframe(1)).warning(msg, *args, stacklevel=2, extra={'color': bcolors.WARNING})
 
 
-def log_success(msg):
+def log_success(msg, *args):
     """
     log a green success message. (INFO level)
     :param msg: The message to include in the log
     :type msg: str
     :return: None
     """
-    if "INFO" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stderr, logging_level=logging.INFO)
-        logger.info(f"{bcolors.OKGREEN + str(msg) + bcolors.ENDC}")
+    if _level <= logging.INFO:
+        _module_logger(sys._getframe(1)).info(msg, *args, stacklevel=2, extra={'color': bcolors.OKGREEN})
 
 
-def log_blue(msg):
+def log_blue(msg, *args):
     """
     log a blue info message.
     :param msg: The message to include in the log
     :type msg: str
     :return: None
     """
-    if "INFO" in _LOGLEVEL:
-        logger = _channel_creator_logger(f=sys.stderr, logging_level=logging.INFO)
-        logger.info(f"{bcolors.OKCYAN + str(msg) + bcolors.ENDC}")
-        
\ No newline at end of file
+    if _level <= logging.INFO:
+        _module_logger(sys._getframe(1)).info(msg, *args, stacklevel=2, extra={'color': bcolors.OKCYAN})